@@ -1,8 +1,15 @@
+# --- Async Mode (must patch the stdlib before anything else is imported) ---
+import async_mode
+async_mode.monkey_patch()
+from async_mode import run_blocking
+
 from werkzeug.utils import secure_filename
 import os
 import json
+import uuid
+import weakref
 from datetime import datetime
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify
+from flask import Flask, current_app, render_template, redirect, url_for, flash, request, jsonify, abort, Response, stream_with_context
 from flask_bootstrap import Bootstrap5
 from flask_login import login_user, logout_user, current_user, login_required
 from flask_socketio import SocketIO, send, emit, join_room, leave_room
@@ -11,34 +18,176 @@ import geopandas as gpd
 from sqlalchemy import func
 
 # Import extensions and models
-from ext import db, login_manager
+from ext import db, login_manager, app_extension
+from user_cache import user_cache, UserCache
+from room_context import room_context, RoomContext
+from favorites import favorites, FavoritesCache
+import export
+import osm_import
+import routing
+import archive
+import finance
+from tiles import tile_index, TileIndex
+from http_cache import http_cache, conditional, HttpCache
+from rate_limit import limiter, send_queues, limit, limit_event, metrics_text, RateLimiter, SendQueues
+from profiling import profiler, Profiler
+from cache_bus import cache_bus, CacheBus
+import presence
+from config import from_env as load_config
+import prefork
 from models import User, Post, Location, Review, Message, Room, Transaction, Outsider, Activity, Constraint
 
 from forms import RegisterForm, LoginForm, PostForm, UpdateAccountForm, ReviewForm, CreateRoomForm, TransactionForm, ActivityForm, ConstraintForm
 
-# --- App Setup ---
-app = Flask(__name__)
+# --- Extensions without an app; create_app() binds them ---
+bootstrap = Bootstrap5()
+socketio = app_extension('socketio')  # each app has its own server, see EventTable
+
+
+class RouteTable:
+    """Collects the views below at import time; create_app() adds them to each app.
+    Unlike a Blueprint, endpoints keep their plain names (url_for('chat_room'))."""
+
+    def __init__(self):
+        self.rules = []
+
+    def route(self, rule, **options):
+        def decorator(view):
+            self.rules.append((rule, options, view))
+            return view
+        return decorator
+
+    def init_app(self, app):
+        for rule, options, view in self.rules:
+            options = dict(options)
+            app.add_url_rule(rule, options.pop('endpoint', view.__name__), view, **options)
+
+
+routes = RouteTable()
+
+
+class EventTable:
+    """The Socket.IO side of RouteTable: handlers collected at import time are
+    registered on the SocketIO server create_app() makes for each app."""
+
+    def __init__(self):
+        self.handlers = []
+
+    def on(self, event, namespace=None):
+        def decorator(handler):
+            self.handlers.append((event, namespace, handler))
+            return handler
+        return decorator
+
+    def init_app(self, socketio):
+        for event, namespace, handler in self.handlers:
+            socketio.on_event(event, handler, namespace)
+
+
+events = EventTable()
 
-# --- Config ---
-app.config['SECRET_KEY'] = 'a-very-secret-key-that-you-should-change'
-basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'friendus.db')
 
-# --- Initialize Extensions ---
-db.init_app(app)
-login_manager.init_app(app)
-bootstrap = Bootstrap5(app) 
-socketio = SocketIO(app)
+def _offload_db(app):
+    # gevent mode: queries from views and handlers go to the thread pool, see async_mode.offload_dbapi
+    with app.app_context():
+        for engine in db.engines.values():
+            async_mode.offload_dbapi(engine)
+
+
+def _sqlite_pragmas(app):
+    # Wait for a busy database instead of failing, and with SQLITE_WAL let readers in
+    # other worker processes run while one writes
+    from sqlalchemy import event
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite': return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_conn, _):
+        cursor = dbapi_conn.cursor()
+        cursor.execute('PRAGMA busy_timeout = 15000')
+        if app.config['SQLITE_WAL']: cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.close()
+
+
+def _reinit_after_fork(app):
+    # A forked worker must not reuse the parent's pooled DB connections (shared sockets / file locks).
+    # close=False leaves the parent's connections alone and just drops them from the child's pool.
+    # The Socket.IO queue manager was built in the parent too; each worker needs its own host id,
+    # or workers take each other's messages for their own and drop them.
+    app_ref = weakref.ref(app)
+
+    def after_fork():
+        app = app_ref()
+        if app is None: return
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+        manager = getattr(app.extensions['socketio'].server, 'manager', None)
+        if hasattr(manager, 'host_id'): manager.host_id = uuid.uuid4().hex
+    os.register_at_fork(after_in_child=after_fork)
+
+
+def create_app(config=None):
+    """Build the Flask app. Settings come from config.DEFAULTS, then FRIENDUS_* environment
+    variables, then `config` (a dict), so tests and workers can each use their own."""
+    app = Flask(__name__)
+    app.config.update(load_config())
+    if config: app.config.update(config)
+
+    db.init_app(app)
+    _offload_db(app)
+    login_manager.init_app(app)
+    bootstrap.init_app(app)
+
+    # Every stateful extension is a new instance in app.extensions; the module-level
+    # names (user_cache, room_context, socketio...) resolve to the current app's
+    options = {}
+    queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if queue and queue.startswith(prefork.LOCAL_SCHEME): options['client_manager'] = prefork.LocalManager(queue)
+    elif queue: options['message_queue'] = queue
+    if app.config['SOCKETIO_TRANSPORTS']: options['transports'] = app.config['SOCKETIO_TRANSPORTS']
+    server = SocketIO(async_mode=async_mode.ASYNC_MODE)
+    events.init_app(server)
+    server.init_app(app, **options)
+    CacheBus().init_app(app, server)
+    SendQueues().init_app(app, server)
+    Profiler().init_app(app, server)
+
+    UserCache().init_app(app)
+    RoomContext().init_app(app)
+    FavoritesCache().init_app(app)
+    TileIndex().init_app(app)
+    HttpCache().init_app(app)
+    RateLimiter().init_app(app)
+    export.init_app(app)
+    osm_import.init_app(app)
+    routing.init_app(app)
+    archive.init_app(app)
+
+    routes.init_app(app)
+
+    @app.context_processor
+    def socketio_client_options():
+        # Passed to io() by the chat pages
+        transports = app.config['SOCKETIO_TRANSPORTS']
+        return {'socketio_options': {'transports': transports} if transports else {}}
+
+    _sqlite_pragmas(app)
+    _reinit_after_fork(app)
+    return app
 
 # --- Login Manager Helper ---
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Called on every request and Socket.IO event, so go through the identity cache
+    return user_cache.get(user_id)
 
 # ... [Keep create_location_on_click and populate_db as they were] ...
 
-@app.route('/api/create_location_on_click', methods=['POST'])
+@routes.route('/api/create_location_on_click', methods=['POST'])
 @login_required
+@limit('create_location')
 def create_location_on_click():
     data = request.json
     existing = Location.query.filter(
@@ -60,6 +209,7 @@ def create_location_on_click():
     
     db.session.add(new_loc)
     db.session.commit()
+    tile_index.add_location(new_loc.id, new_loc.latitude, new_loc.longitude)
     return jsonify({'url': url_for('location_detail', location_id=new_loc.id)})
 
 def populate_db():
@@ -132,8 +282,8 @@ def check_conflicts(activities, constraints):
 # --- Routes ---
 
 # ... [Keep index, login, register, logout, profile, account, map, location routes exactly as before] ...
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
+@routes.route('/', methods=['GET', 'POST'])
+@routes.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     form = PostForm()
@@ -142,12 +292,13 @@ def index():
         if form.media.data:
             file = form.media.data
             filename = secure_filename(file.filename)
-            upload_folder = os.path.join(app.root_path, 'static', 'uploads')
+            upload_folder = os.path.join(current_app.root_path, 'static', 'uploads')
             if not os.path.exists(upload_folder): os.makedirs(upload_folder)
-            file.save(os.path.join(upload_folder, filename))
+            run_blocking(file.save, os.path.join(upload_folder, filename))
 
         post = Post(body=form.body.data, author=current_user, media_filename=filename)
         db.session.add(post)
+        http_cache.bump('user_posts', current_user.id)
         db.session.commit()
         return redirect(url_for('index'))
     
@@ -156,7 +307,7 @@ def index():
     suggestions = db.session.query(Location, avg_rating).outerjoin(Review, Location.id == Review.location_id).group_by(Location.id).order_by(avg_rating.desc()).limit(5).all() 
     return render_template('index.html', title='Home', form=form, posts=posts, suggestions=suggestions)
 
-@app.route('/login', methods=['GET', 'POST'])
+@routes.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated: return redirect(url_for('index'))
     form = LoginForm()
@@ -168,7 +319,7 @@ def login():
         else: flash('Login Unsuccessful.', 'danger')
     return render_template('login.html', title='Login', form=form)
 
-@app.route('/register', methods=['GET', 'POST'])
+@routes.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated: return redirect(url_for('index'))
     form = RegisterForm()
@@ -179,26 +330,34 @@ def register():
         return redirect(url_for('login'))
     return render_template('register.html', title='Register', form=form)
 
-@app.route('/logout')
+@routes.route('/logout')
 def logout():
     logout_user()
     return redirect(url_for('index'))
 
-@app.route('/profile/<username>')
+def profile_stamps(username):
+    user_id = db.session.query(User.id).filter_by(username=username).scalar()
+    return None if user_id is None else [('user_posts', user_id)]
+
+@routes.route('/profile/<username>')
 @login_required
+@conditional(profile_stamps)
 def profile(username):
     user = User.query.filter_by(username=username).first_or_404()
     posts = Post.query.filter_by(author=user).order_by(Post.timestamp.desc()).all()
     return render_template('profile.html', title='Profile', user=user, posts=posts)
 
-@app.route('/account', methods=['GET', 'POST'])
+@routes.route('/account', methods=['GET', 'POST'])
 @login_required
 def account():
     form = UpdateAccountForm()
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.email = form.email.data
+        http_cache.bump('users', 0)
         db.session.commit()
+        user_cache.invalidate(current_user.id)
+        room_context.bump_user_rooms(current_user.id)
         flash('Account updated!', 'success')
         return redirect(url_for('account'))
     elif request.method == 'GET':
@@ -206,12 +365,12 @@ def account():
         form.email.data = current_user.email
     return render_template('account.html', title='Account', form=form)
 
-@app.route('/map')
+@routes.route('/map')
 @login_required
 def map():
     return redirect(url_for('map_search'))
 
-@app.route('/map/search')
+@routes.route('/map/search')
 @login_required
 def map_search():
     # ... (Existing map search code) ...
@@ -230,69 +389,111 @@ def map_search():
     if query_price: query = query.filter(Location.price_range == query_price)
     if query_rating: query = query.having(avg_rating >= query_rating)
 
+    # Without filters the map pulls pre-clustered tiles from /api/tiles instead of every location
+    use_tiles = not any((query_name, query_type, query_price, query_rating))
+
+    my_favorites = favorites.get(current_user.id)
     locations_data = []
-    for loc, rating in query.all():
+    for loc, rating in ([] if use_tiles else query.all()):
         locations_data.append({
             'id': loc.id, 'name': loc.name, 'desc': loc.description,
             'lat': loc.latitude, 'lon': loc.longitude,
             'url': url_for('location_detail', location_id=loc.id),
-            'rating': float(rating)
+            'rating': float(rating),
+            'favorited': loc.id in my_favorites
         })
     
     return render_template('map.html', title='Map Search', 
                            query=query_name, query_type=query_type,
                            query_price=query_price, query_rating=query_rating,
-                           locations_data=locations_data, default_lat=lat, default_lon=lon)
+                           locations_data=locations_data, use_tiles=use_tiles, default_lat=lat, default_lon=lon)
 
-@app.route('/location/<int:location_id>', methods=['GET', 'POST'])
+@routes.route('/location/<int:location_id>', methods=['GET', 'POST'])
 @login_required
+@conditional(lambda location_id: [('location', location_id)])
 def location_detail(location_id):
     location = Location.query.get_or_404(location_id)
     form = ReviewForm()
-    is_favorited = current_user.favorite_locations.filter(Location.id == location.id).count() > 0
+    is_favorited = location.id in favorites.get(current_user.id)
     
     if form.validate_on_submit():
         review = Review(body=form.body.data, rating=int(form.rating.data), author=current_user, location=location)
         db.session.add(review)
+        http_cache.bump('location', location.id)
         db.session.commit()
+        new_avg = db.session.query(func.avg(Review.rating)).filter(Review.location_id == location.id).scalar()
+        tile_index.update_rating(location.id, float(new_avg or 0))
         return redirect(url_for('location_detail', location_id=location.id))
     
     reviews = Review.query.filter_by(location=location).order_by(Review.timestamp.desc()).all()
-    return render_template('location_detail.html', title=location.name, location=location, form=form, reviews=reviews, is_favorited=is_favorited)
+    favorites_count = favorites.counts([location.id])[location.id]
+    return render_template('location_detail.html', title=location.name, location=location, form=form, reviews=reviews,
+                           is_favorited=is_favorited, favorites_count=favorites_count)
 
-@app.route('/location/favorite/<int:location_id>', methods=['POST'])
+@routes.route('/location/favorite/<int:location_id>', methods=['POST'])
 @login_required
+@limit('favorite')
 def add_favorite(location_id):
     location = Location.query.get_or_404(location_id)
-    # Check if already favorited to avoid duplicates
-    if not current_user.favorite_locations.filter(Location.id == location.id).count() > 0:
-        current_user.favorite_locations.append(location)
+    # Idempotent: favoriting twice is a no-op
+    if favorites.add(current_user.id, location.id):
+        http_cache.bump('location', location.id)  # one commit with the favorite row
         db.session.commit()
+        favorites.invalidate(current_user.id)
         flash(f'Added {location.name} to favorites!', 'success')
     return redirect(url_for('location_detail', location_id=location_id))
 
-@app.route('/location/unfavorite/<int:location_id>', methods=['POST'])
+@routes.route('/location/unfavorite/<int:location_id>', methods=['POST'])
 @login_required
+@limit('favorite')
 def remove_favorite(location_id):
     location = Location.query.get_or_404(location_id)
-    # Check if it exists before removing
-    if current_user.favorite_locations.filter(Location.id == location.id).count() > 0:
-        current_user.favorite_locations.remove(location)
+    if favorites.remove(current_user.id, location.id):
+        http_cache.bump('location', location.id)  # one commit with the favorite row
         db.session.commit()
+        favorites.invalidate(current_user.id)
         flash(f'Removed {location.name} from favorites.', 'info')
     return redirect(url_for('location_detail', location_id=location_id))
 
+@routes.route('/api/locations/favorites', methods=['POST'])
+@login_required
+def api_favorites_status():
+    # Favorite flag + popularity for many map markers in one call: {"ids": [1, 2, ...]}
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict): return jsonify({'error': 'expected a JSON object'}), 400
+    ids = data.get('ids', [])
+    if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return jsonify({'error': 'ids must be a list of integers'}), 400
+    if len(ids) > current_app.config['FAVORITES_BATCH_MAX']:
+        return jsonify({'error': f"At most {current_app.config['FAVORITES_BATCH_MAX']} ids per request"}), 400
+    return jsonify({'locations': favorites.status(current_user.id, ids)})
+
+@routes.route('/api/tiles/<int:z>/<int:x>/<int:y>.json')
+@login_required
+def map_tile(z, x, y):
+    if z > 22 or x >= 1 << z or y >= 1 << z: abort(404)
+    tile_index.refresh()
+    etag = tile_index.etag(z, x, y)
+    # Answer revalidations before rendering anything
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(tile_index.render(z, x, y), mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 # --- CHAT & MERGED FEATURES ---
 
 # --- FIX FOR LEGACY NAVIGATION LINKS ---
-@app.route('/finance')
+@routes.route('/finance')
 @login_required
 def finance_dashboard():
     # Redirect old Finance link to the Chat Lobby
     flash('Finance features are now inside each Chat Room. Please join a room to view them.', 'info')
     return redirect(url_for('chat'))
 
-@app.route('/chat/delete/<int:room_id>', methods=['POST'])
+@routes.route('/chat/delete/<int:room_id>', methods=['POST'])
 @login_required
 def delete_chat_room(room_id):
     room_to_delete = Room.query.get_or_404(room_id)
@@ -308,12 +509,13 @@ def delete_chat_room(room_id):
         return redirect(url_for('chat'))
         
     try:
-        # Delete messages associated with this room
-        Message.query.filter_by(room=room_to_delete.name).delete()
-        
-        # Delete the room itself
+        # Delete the room itself; its messages are purged in the background
+        room_name = room_to_delete.name
+        marks = archive.purge_marks(room_name)
         db.session.delete(room_to_delete)
         db.session.commit()
+        room_context.bump(room_id)
+        socketio.start_background_task(purge_room_messages, current_app._get_current_object(), room_name, *marks)
         flash(f'Room "{room_to_delete.name}" has been deleted.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -321,7 +523,7 @@ def delete_chat_room(room_id):
         
     return redirect(url_for('chat'))
 
-@app.route('/chat', methods=['GET', 'POST'])
+@routes.route('/chat', methods=['GET', 'POST'])
 @login_required
 def chat():
     form = CreateRoomForm()
@@ -330,21 +532,21 @@ def chat():
         new_room.members.append(current_user)
         db.session.add(new_room)
         db.session.commit()
+        room_context.bump(new_room.id)
         return redirect(url_for('chat_room', room_name=new_room.name))
 
     all_rooms = Room.query.all()
     my_rooms = current_user.rooms.all()
     return render_template('chat_lobby.html', title='Chat Lobby', form=form, all_rooms=all_rooms, my_rooms=my_rooms)
 
-@app.route('/chat/<string:room_name>', methods=['GET'])
+@routes.route('/chat/<string:room_name>', methods=['GET'])
 @login_required
 def chat_room(room_name):
-    room = Room.query.filter_by(name=room_name).first_or_404()
+    room = room_context.get_by_name_or_404(room_name)
     
     # Auto-join
-    if current_user not in room.members:
-        room.members.append(current_user)
-        db.session.commit()
+    if room_context.add_member(room.id, current_user.id):
+        room = room_context.get(room.id)
         flash(f'Joined room: {room.name}', 'info')
 
     # --- PLANNER DATA ---
@@ -367,7 +569,7 @@ def chat_room(room_name):
 
     # --- FINANCE DATA ---
     trans_form = TransactionForm()
-    trans_form.receiver.choices = [(m.id, m.username) for m in room.members if m.id != current_user.id]
+    trans_form.receiver.choices = [(uid, name) for uid, name in room.members.items() if uid != current_user.id]
     if not trans_form.receiver.choices: trans_form.receiver.choices = [(0, 'No other members')]
 
     pending_trans = Transaction.query.filter_by(room_id=room.id, receiver_id=current_user.id, status='pending').all()
@@ -383,16 +585,17 @@ def chat_room(room_name):
                            constraints=my_constraints, conflicts=conflicts,
                            trans_form=trans_form, pending_trans=pending_trans, history_trans=history_trans)
 
-@app.route('/room/<int:room_id>/add_activity', methods=['POST'])
+@routes.route('/room/<int:room_id>/add_activity', methods=['POST'])
 @login_required
+@limit('room_write')
 def add_room_activity(room_id):
-    room = Room.query.get_or_404(room_id)
+    room = room_context.get_or_404(room_id)
     form = ActivityForm()
     if form.validate_on_submit():
         new_act = Activity(
             name=form.name.data, location=form.location.data, price=form.price.data,
             start_time=form.start_time.data, end_time=form.end_time.data,
-            rating=form.rating.data if form.rating.data else 0, room=room
+            rating=form.rating.data if form.rating.data else 0, room_id=room.id
         )
         db.session.add(new_act)
         db.session.commit()
@@ -401,10 +604,11 @@ def add_room_activity(room_id):
         flash('Error adding activity.', 'danger')
     return redirect(url_for('chat_room', room_name=room.name))
 
-@app.route('/room/<int:room_id>/add_constraint', methods=['POST'])
+@routes.route('/room/<int:room_id>/add_constraint', methods=['POST'])
 @login_required
+@limit('room_write')
 def add_room_constraint(room_id):
-    room = Room.query.get_or_404(room_id)
+    room = room_context.get_or_404(room_id)
     form = ConstraintForm()
     
     if form.validate_on_submit():
@@ -426,13 +630,14 @@ def add_room_constraint(room_id):
                 
     return redirect(url_for('chat_room', room_name=room.name))
 
-@app.route('/room/<int:room_id>/add_transaction', methods=['POST'])
+@routes.route('/room/<int:room_id>/add_transaction', methods=['POST'])
 @login_required
+@limit('room_write')
 def add_room_transaction(room_id):
-    room = Room.query.get_or_404(room_id)
+    room = room_context.get_or_404(room_id)
     form = TransactionForm()
     # Re-populate choices for validation
-    form.receiver.choices = [(m.id, m.username) for m in room.members if m.id != current_user.id]
+    form.receiver.choices = [(uid, name) for uid, name in room.members.items() if uid != current_user.id]
     if not form.receiver.choices: form.receiver.choices = [(0, 'No members')]
 
     if form.validate_on_submit():
@@ -445,21 +650,53 @@ def add_room_transaction(room_id):
             outsider = Outsider.query.filter_by(name=o_name, creator_id=current_user.id).first()
             if not outsider:
                 outsider = Outsider(name=o_name, creator_id=current_user.id)
-                db.session.add(outsider)
-                db.session.commit()
-            new_trans.outsider_id = outsider.id
+                db.session.add(outsider)  # inserted with the transaction below, one commit
+            new_trans.outsider = outsider
             new_trans.status = 'confirmed' 
         else:
             new_trans.receiver_id = form.receiver.data
         
         db.session.add(new_trans)
+        http_cache.bump('room_transactions', room.id)
         db.session.commit()
         flash('Transaction recorded.', 'success')
     else:
         flash('Invalid transaction data.', 'danger')
     return redirect(url_for('chat_room', room_name=room.name))
 
-@app.route('/finance/confirm/<int:trans_id>', methods=['POST'])
+@routes.route('/api/room/<int:room_id>/split', methods=['POST'])
+@login_required
+@limit('room_write')
+def api_split_expense(room_id):
+    # One shared expense in one request and one commit:
+    # {"total": 1200000, "description": "Dinner", "mode": "equal" | "shares" | "exact", "payer_id": 1,
+    #  "participants": [{"user_id": 2}, {"outsider": "Minh", "shares": 2}, {"user_id": 3, "amount": 300000}]}
+    room = room_context.get_or_404(room_id)
+    if not room_context.is_member(room.id, current_user.id): abort(403)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict): return jsonify({'error': 'expected a JSON object'}), 400
+    participants = data.get('participants')
+    if not isinstance(participants, list) or not all(isinstance(p, dict) for p in participants):
+        return jsonify({'error': 'participants must be a list of objects'}), 400
+    if len(participants) > current_app.config['SPLIT_MAX_PARTICIPANTS']:
+        return jsonify({'error': f"At most {current_app.config['SPLIT_MAX_PARTICIPANTS']} participants per split"}), 400
+    description = str(data.get('description') or '').strip()[:200]
+    if not description: return jsonify({'error': 'description is required'}), 400
+    try:
+        rows = finance.build_split(room, current_user.id, data.get('payer_id', current_user.id),
+                                   data.get('total', 0), data.get('mode', 'equal'), participants, description)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    http_cache.bump('room_transactions', room.id)  # the debt graph changes once, whatever the row count
+    db.session.flush()
+    # Built before the commit, which would expire every row and reload each one on access
+    created = [{'id': t.id, 'amount': t.amount, 'status': t.status,
+                'receiver_id': t.receiver_id, 'outsider': t.outsider.name if t.outsider else None} for t in rows]
+    db.session.commit()
+    return jsonify({'transactions': created}), 201
+
+@routes.route('/finance/confirm/<int:trans_id>', methods=['POST'])
 @login_required
 def confirm_transaction(trans_id):
     trans = Transaction.query.get_or_404(trans_id)
@@ -468,30 +705,44 @@ def confirm_transaction(trans_id):
     if trans.receiver_id != current_user.id:
         return redirect(url_for('chat_room', room_name=room_name))
     trans.status = 'confirmed'
+    http_cache.bump('room_transactions', trans.room_id)
     db.session.commit()
     return redirect(url_for('chat_room', room_name=room_name))
 
-@app.route('/finance/delete/<int:trans_id>', methods=['POST'])
+@routes.route('/finance/delete/<int:trans_id>', methods=['POST'])
 @login_required
 def delete_transaction(trans_id):
     trans = Transaction.query.get_or_404(trans_id)
     room_name = trans.room.name
     if trans.sender_id == current_user.id:
+        http_cache.bump('room_transactions', trans.room_id)
         db.session.delete(trans)
         db.session.commit()
     return redirect(url_for('chat_room', room_name=room_name))
 
+@routes.route('/room/<int:room_id>/export/<kind>.<fmt>')
+@login_required
+def export_room_data(room_id, kind, fmt):
+    room = room_context.get_or_404(room_id)
+    if kind not in export.KINDS or fmt not in export.FORMATS: abort(404)
+    if not room_context.is_member(room.id, current_user.id): abort(403)
+    # Rows are streamed chunk by chunk from the DB cursor, so memory stays flat for any room size
+    filename = secure_filename(f"{room.name}-{kind}.{fmt}")
+    return Response(stream_with_context(export.stream_export(kind, room, fmt)),
+                    mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 # --- FIX FOR LEGACY PLANNER LINKS ---
-@app.route('/planner/<int:room_id>')
+@routes.route('/planner/<int:room_id>')
 @login_required
 def planner(room_id):
     # Find the room
-    room = Room.query.get_or_404(room_id)
+    room = room_context.get_or_404(room_id)
     # Redirect to the new Chat Room view (where the planner now lives)
     flash('The Planner is now located inside the Chat Room tabs.', 'info')
     return redirect(url_for('chat_room', room_name=room.name))
 
-@app.route('/planner/delete_activity/<int:id>')
+@routes.route('/planner/delete_activity/<int:id>')
 @login_required
 def delete_activity(id):
     act = Activity.query.get_or_404(id)
@@ -500,7 +751,7 @@ def delete_activity(id):
     db.session.commit()
     return redirect(url_for('chat_room', room_name=room_name))
 
-@app.route('/planner/delete_constraint/<int:id>')
+@routes.route('/planner/delete_constraint/<int:id>')
 @login_required
 def delete_constraint(id):
     cons = Constraint.query.get_or_404(id)
@@ -510,8 +761,9 @@ def delete_constraint(id):
         db.session.commit()
     return redirect(url_for('chat_room', room_name=room_name))
 
-@app.route('/api/finance_graph')
+@routes.route('/api/finance_graph')
 @login_required
+@conditional(lambda: [('room_transactions', request.args.get('room_id', type=int) or 0)])
 def api_finance_graph():
     # FILTER BY ROOM ID
     room_id = request.args.get('room_id', type=int)
@@ -529,96 +781,211 @@ def api_finance_graph():
     nodes = [{'id': n, 'label': n, 'shape': 'dot', 'size': 20} for n in nodes_set]
     return jsonify({'nodes': nodes, 'edges': edges})
 
+@routes.route('/api/room/<int:room_id>/travel')
+@login_required
+def api_room_travel(room_id):
+    room = room_context.get_or_404(room_id)
+    if not room_context.is_member(room.id, current_user.id): abort(403)
+    graph = routing.get_graph()
+    if graph is None:
+        return jsonify({'error': 'Routing graph not built. Run: flask --app app build-graph --help'}), 503
+
+    # Activities only store a location name; resolve it against Location
+    activities = Activity.query.filter_by(room_id=room.id).all()
+    names = {a.location for a in activities if a.location}
+    places = {name: (lat, lon) for name, lat, lon in
+              db.session.query(Location.name, Location.latitude, Location.longitude).filter(Location.name.in_(names))}
+    located = sorted((a for a in activities if a.location in places), key=lambda a: (a.start_time or '99:99', a.id))
+    # Places too far from any street of the graph get no (meaningless) travel time
+    snapped = graph.nearest_nodes([places[a.location][0] for a in located], [places[a.location][1] for a in located],
+                                  max_meters=current_app.config['ROUTING_MAX_SNAP_METERS']) if located else []
+    nodes = [int(n) for n in snapped if n >= 0]
+    located = [a for a, n in zip(located, snapped) if n >= 0]
+    unlocated = [a.id for a in activities if a not in located]
+    if not located:
+        return jsonify({'activities': [], 'unlocated': unlocated, 'matrix': [], 'legs': []})
+
+    lats, lons = zip(*(places[a.location] for a in located))
+    legs = routing.route_legs(graph, nodes)
+
+    itinerary = []
+    for a, b, src, dst in zip(located, located[1:], nodes, nodes[1:]):
+        seconds, meters, path = legs[(src, dst)]
+        itinerary.append({'from': a.id, 'to': b.id, 'seconds': seconds, 'meters': meters,
+                          'path': graph.coords(path) if path else None})
+
+    return jsonify({
+        'activities': [{'id': a.id, 'name': a.name, 'location': a.location, 'lat': lat, 'lon': lon}
+                       for a, lat, lon in zip(located, lats, lons)],
+        'unlocated': unlocated,
+        'matrix': routing.travel_matrix(graph, nodes),
+        'legs': itinerary,
+    })
+
+@routes.route('/metrics')
+def metrics():
+    # Scraped from the host itself; not exposed to remote clients
+    if request.remote_addr not in ('127.0.0.1', '::1'): abort(404)
+    return Response(metrics_text(limiter, send_queues, presence.worker_id()), mimetype='text/plain; version=0.0.4')
+
+# --- PROFILING (FRIENDUS_PROFILING=1, admins from FRIENDUS_PROFILING_ADMINS) ---
+@routes.route('/admin/profiling', methods=['GET', 'POST'])
+@login_required
+def profiling_status():
+    # POST {"target": "endpoint:map_search" | "event:send_message", "engine": "cprofile" | "pyinstrument", "count": 1}
+    if not profiler.is_admin(): abort(404)
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            profiler.arm(str(data['target']), data.get('engine', 'cprofile'), int(data.get('count', 1)))
+        except (KeyError, TypeError, ValueError, RuntimeError) as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify(profiler.status())
+
+@routes.route('/admin/profiling/<int:capture_id>')
+@login_required
+def profiling_capture(capture_id):
+    if not profiler.is_admin(): abort(404)
+    capture = profiler.get(capture_id)
+    if not capture: abort(404)
+    return Response(capture['body'], mimetype=capture['mimetype'])
+
+@routes.route('/admin/profiling/sampler', methods=['POST'])
+@login_required
+def profiling_sampler():
+    # {"action": "start", "interval_ms": 10, "seconds": 60, "idle": false} or {"action": "stop"}
+    if not profiler.is_admin(): abort(404)
+    data = request.get_json(silent=True) or {}
+    if data.get('action') == 'stop':
+        profiler.sampler.stop()
+    else:
+        try:
+            profiler.sampler.start(float(data.get('interval_ms', 10)) / 1000, float(data.get('seconds', 60)), bool(data.get('idle')))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'interval_ms and seconds must be finite, positive numbers'}), 400
+    return jsonify(profiler.sampler.status())
+
+@routes.route('/admin/profiling/stacks.collapsed')
+def profiling_stacks():
+    # Local endpoint: curl it on the host, or download it as an admin
+    if not profiler.enabled: abort(404)
+    if request.remote_addr not in ('127.0.0.1', '::1') and not profiler.is_admin(): abort(404)
+    return Response(profiler.sampler.collapsed(), mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename="stacks.collapsed"'})
+
 # --- SOCKETIO ---
-online_users_in_rooms = {}
+
+# DB work for the handlers below. Kept as plain functions so they can be
+# handed to run_blocking() and not stall the event loop in gevent mode.
+def is_room_member(room_name, user_id):
+    room = room_context.get_by_name(room_name)
+    return room is not None and room_context.is_member(room.id, user_id)
+
+def load_room_history(room_name, before_id=None):
+    # Newest page first; older pages are read through to the archive
+    return archive.room_history(room_name, before_id)
+
+def purge_room_messages(app, room_name, max_msg_id, max_segment_id):
+    with app.app_context():
+        try: run_blocking(archive.purge_room, room_name, max_msg_id, max_segment_id)
+        except Exception as e: print(f"Error purging room {room_name}: {e}")
+
+def save_message(body, room_name, user_id, username):
+    if not is_room_member(room_name, user_id): return None
+    new_msg = Message(body=body, room=room_name, user_id=user_id)
+    db.session.add(new_msg)
+    db.session.commit()
+    return {'id': new_msg.id, 'msg': new_msg.body, 'username': username,
+            'timestamp': new_msg.timestamp.strftime('%Y-%m-%d %H:%M')}
 
 def get_users_in_room(room_name):
-    if room_name in online_users_in_rooms:
-        # ERROR WAS HERE: It was returning every connection, including duplicates.
-        # FIX: Use set() to remove duplicate usernames, then convert back to list.
-        return list(set(online_users_in_rooms[room_name].values()))
-    return []
+    # Shared by every worker, so the list includes sockets connected to the others
+    return run_blocking(presence.users, room_name)
 
-@socketio.on('connect')
+@events.on('connect')
 def handle_connect():
     if not current_user.is_authenticated: return False
+    cache_bus.start()
 
-@socketio.on('join')
+@events.on('join')
+@limit_event('join')
 def handle_join(data):
     if not current_user.is_authenticated: return
     room_name = data['room']
-    
-    if room_name not in online_users_in_rooms: 
-        online_users_in_rooms[room_name] = {}
-    
-    # --- FIX: Remove any old connections for this specific user in this room ---
-    # This cleans up "ghost" connections from page refreshes
-    current_sids = [sid for sid, user in online_users_in_rooms[room_name].items() if user == current_user.username]
-    for old_sid in current_sids:
-        del online_users_in_rooms[room_name][old_sid]
-    # -------------------------------------------------------------------------
-
-    online_users_in_rooms[room_name][request.sid] = current_user.username
+    if not run_blocking(is_room_member, room_name, current_user.id): return
+
+    # Keeps the user's other tabs; drops their sockets here that disconnected without a 'disconnect'
+    manager = socketio.server.manager
+    run_blocking(presence.join, room_name, request.sid, current_user.id, lambda sid: manager.is_connected(sid, '/'))
     join_room(room_name)
     
-    emit('status', {'msg': f'{current_user.username} has joined.'}, to=room_name)
+    send_queues.fanout('status', {'msg': f'{current_user.username} has joined.'}, room_name, 'drop')
     
     # ... (rest of the function stays the same) ...
     try:
-        messages = Message.query.filter_by(room=room_name).order_by(Message.timestamp.asc()).limit(50).all()
-        history = [{'msg': m.body, 'username': m.author.username, 'timestamp': m.timestamp.strftime('%Y-%m-%d %H:%M')} for m in messages]
-        emit('load_history', history, to=request.sid)
+        emit('load_history', run_blocking(load_room_history, room_name), to=request.sid)
     except Exception as e: print(f"Error history: {e}")
     
-    emit('user_list', {'users': get_users_in_room(room_name)}, to=room_name)
+    send_queues.fanout('user_list', {'users': get_users_in_room(room_name)}, room_name, 'coalesce')
 
-@socketio.on('send_message')
+@events.on('send_message')
+@limit_event('send_message')
 def handle_send_message(data):
     if current_user.is_authenticated:
         try:
-            new_msg = Message(body=data['msg'], room=data['room'], author=current_user)
-            db.session.add(new_msg)
-            db.session.commit()
-            emit('receive_message', {
-                'msg': new_msg.body, 'username': new_msg.author.username,
-                'timestamp': new_msg.timestamp.strftime('%Y-%m-%d %H:%M')
-            }, to=data['room'])
+            payload = run_blocking(save_message, data['msg'], data['room'], current_user.id, current_user.username)
+            if payload: send_queues.fanout('receive_message', payload, data['room'])
         except Exception: db.session.rollback()
 
-@socketio.on('leave')
+@events.on('load_older')
+@limit_event('load_older')
+def handle_load_older(data):
+    if not current_user.is_authenticated: return
+    room_name = data['room']
+    if not run_blocking(is_room_member, room_name, current_user.id): return
+    try: before_id = int(data['before'])
+    except (KeyError, TypeError, ValueError): return
+    emit('older_history', run_blocking(load_room_history, room_name, before_id), to=request.sid)
+
+@events.on('leave')
 def handle_leave(data):
     if not current_user.is_authenticated: return
     room_name = data['room']
     leave_room(room_name)
-    if room_name in online_users_in_rooms and request.sid in online_users_in_rooms[room_name]:
-        username = online_users_in_rooms[room_name].pop(request.sid)
-        emit('status', {'msg': f'{username} has left.'}, to=room_name)
-        emit('user_list', {'users': get_users_in_room(room_name)}, to=room_name)
+    for _, username in run_blocking(presence.leave, request.sid, room_name):
+        send_queues.fanout('status', {'msg': f'{username} has left.'}, room_name, 'drop')
+        send_queues.fanout('user_list', {'users': get_users_in_room(room_name)}, room_name, 'coalesce')
 
-@socketio.on('disconnect')
+@events.on('disconnect')
 def handle_disconnect():
     if not current_user.is_authenticated: return
-    for room_name, users in online_users_in_rooms.items():
-        if request.sid in users:
-            username = users.pop(request.sid)
-            emit('status', {'msg': f'{username} has left.'}, to=room_name)
-            emit('user_list', {'users': get_users_in_room(room_name)}, to=room_name)
-            break
-
-@socketio.on('typing')
+    send_queues.typing.difference_update([k for k in send_queues.typing if k[0] == request.sid])
+    for room_name, username in run_blocking(presence.leave, request.sid):
+        send_queues.fanout('status', {'msg': f'{username} has left.'}, room_name, 'drop')
+        send_queues.fanout('user_list', {'users': get_users_in_room(room_name)}, room_name, 'coalesce')
+
+@events.on('typing')
+@limit_event('typing', notify=False)
 def handle_typing(data):
     if current_user.is_authenticated:
-        emit('typing_status', {'username': current_user.username, 'isTyping': True}, to=data['room'], include_self=False)
+        send_queues.typing.add((request.sid, data['room']))
+        send_queues.fanout('typing_status', {'username': current_user.username, 'isTyping': True}, data['room'], 'drop', skip_sid=request.sid)
 
-@socketio.on('stopped_typing')
+@events.on('stopped_typing')
 def handle_stopped_typing(data):
-    if current_user.is_authenticated:
-        emit('typing_status', {'username': current_user.username, 'isTyping': False}, to=data['room'], include_self=False)
+    # Not rate limited, so it can always clear a "typing..." others saw; but it is only
+    # forwarded after a forwarded 'typing', which is. Repeated stops fan out nothing.
+    if current_user.is_authenticated and (request.sid, data['room']) in send_queues.typing:
+        send_queues.typing.discard((request.sid, data['room']))
+        send_queues.fanout('typing_status', {'username': current_user.username, 'isTyping': False}, data['room'], 'coalesce', skip_sid=request.sid)
 
 if __name__ == '__main__':
+    # Single process with the reloader, for development. Multi-core: python prefork.py --workers N
+    app = create_app()
     with app.app_context():
         db.create_all()
         populate_db() 
+        presence.clear_host()
 
     # Print the clickable link
     print("----------------------------------------------------------------")
@@ -626,4 +993,5 @@ if __name__ == '__main__':
     print("http://127.0.0.1:5000")
     print("----------------------------------------------------------------")
 
-    socketio.run(app, host='0.0.0.0', debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    # FRIENDUS_ASYNC_MODE=gevent switches to the cooperative server
+    app.extensions['socketio'].run(app, host='0.0.0.0', debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
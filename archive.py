@@ -0,0 +1,135 @@
+import json
+import zlib
+import click
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func
+
+from ext import db
+from models import Message, MessageArchive, User
+
+# Messages per compressed cold-storage segment
+SEGMENT_SIZE = 500
+PAGE_SIZE = 50
+PURGE_BATCH = 5000
+
+
+def _pack(rows):
+    payload = [[msg_id, user_id, ts.isoformat(), body] for msg_id, user_id, ts, body in rows]
+    return zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def _unpack(data):
+    return [(msg_id, user_id, datetime.fromisoformat(ts), body)
+            for msg_id, user_id, ts, body in json.loads(zlib.decompress(data))]
+
+
+# --- Hot -> cold ---
+def archive_messages(older_than, segment_size=SEGMENT_SIZE):
+    """Move messages with timestamp < older_than into compressed per-room segments.
+
+    Each segment is written and its hot rows deleted in the same commit, so a crash
+    never loses or duplicates messages. Returns the number of messages moved.
+    """
+    # SQLite gives a new row max(rowid) + 1: the newest message stays hot so that ids
+    # never restart below archived ones (paging and exports go by id)
+    newest = db.session.query(func.max(Message.id)).scalar() or 0
+    old = (Message.timestamp < older_than, Message.id < newest)
+    rooms = [room for (room,) in db.session.query(Message.room).filter(*old).distinct()]
+    moved = 0
+    for room in rooms:
+        while True:
+            rows = db.session.query(Message.id, Message.user_id, Message.timestamp, Message.body) \
+                .filter(Message.room == room, *old) \
+                .order_by(Message.id).limit(segment_size).all()
+            if not rows: break
+            db.session.add(MessageArchive(
+                room=room, first_id=rows[0][0], last_id=rows[-1][0],
+                first_timestamp=rows[0][2], last_timestamp=rows[-1][2],
+                count=len(rows), data=_pack(rows)
+            ))
+            db.session.query(Message).filter(Message.id.in_([r[0] for r in rows])).delete(synchronize_session=False)
+            db.session.commit()
+            moved += len(rows)
+    return moved
+
+
+# --- Reading across both tiers ---
+def room_history(room_name, before_id=None, limit=PAGE_SIZE):
+    """The `limit` newest messages of a room with id < before_id, oldest first.
+
+    Reads the hot table first and only opens archive segments when the page
+    reaches past it, so normal chat loads never touch cold storage.
+    """
+    query = db.session.query(Message.id, Message.user_id, Message.timestamp, Message.body).filter(Message.room == room_name)
+    if before_id: query = query.filter(Message.id < before_id)
+    rows = [tuple(r) for r in query.order_by(Message.id.desc()).limit(limit)]
+
+    if len(rows) < limit:
+        cutoff = rows[-1][0] if rows else before_id
+        segments = db.session.query(MessageArchive.data).filter(MessageArchive.room == room_name)
+        if cutoff: segments = segments.filter(MessageArchive.first_id < cutoff)
+        for (data,) in segments.order_by(MessageArchive.last_id.desc()).yield_per(4):
+            older = [r for r in reversed(_unpack(data)) if not cutoff or r[0] < cutoff]
+            rows.extend(older[:limit - len(rows)])
+            if len(rows) >= limit: break
+
+    user_ids = {r[1] for r in rows}
+    names = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids))) if user_ids else {}
+    return [{'id': msg_id, 'msg': body, 'username': names.get(user_id, 'Unknown'),
+             'timestamp': ts.strftime('%Y-%m-%d %H:%M')}
+            for msg_id, user_id, ts, body in reversed(rows)]
+
+
+def archived_rows(room_name):
+    """Every archived message of a room as (id, timestamp, username, body), in id order.
+
+    For exports: segments are decompressed one at a time, with one username query each.
+    """
+    segments = db.session.query(MessageArchive.data).filter(MessageArchive.room == room_name) \
+        .order_by(MessageArchive.first_id)
+    for (data,) in segments.yield_per(4):
+        rows = _unpack(data)
+        user_ids = {r[1] for r in rows}
+        names = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids))) if user_ids else {}
+        for msg_id, user_id, ts, body in rows:
+            yield msg_id, ts, names.get(user_id), body
+
+
+# --- Room deletes ---
+def purge_marks(room_name):
+    """Highest message / segment ids of a room right now. A purge stops there, so a new room
+    created later under the same name keeps its messages."""
+    max_msg = db.session.query(func.max(Message.id)).filter(Message.room == room_name).scalar() or 0
+    max_seg = db.session.query(func.max(MessageArchive.id)).filter(MessageArchive.room == room_name).scalar() or 0
+    return max_msg, max_seg
+
+
+def purge_room(room_name, max_msg_id, max_segment_id, batch=PURGE_BATCH):
+    """Delete a deleted room's messages in small batches so no single transaction holds the write lock for long."""
+    while True:
+        ids = [i for (i,) in db.session.query(Message.id)
+               .filter(Message.room == room_name, Message.id <= max_msg_id).limit(batch)]
+        if not ids: break
+        db.session.query(Message).filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    db.session.query(MessageArchive).filter(
+        MessageArchive.room == room_name, MessageArchive.id <= max_segment_id
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# --- CLI: flask --app app archive-messages (run it from cron) ---
+@click.command('archive-messages')
+@click.option('--days', type=int, default=None, help='Archive messages older than this (default: MESSAGE_RETENTION_DAYS)')
+@click.option('--segment-size', type=int, default=SEGMENT_SIZE, show_default=True)
+def archive_messages_command(days, segment_size):
+    """Move old chat messages into compressed cold storage."""
+    days = days if days is not None else current_app.config['MESSAGE_RETENTION_DAYS']
+    moved = archive_messages(datetime.utcnow() - timedelta(days=days), segment_size)
+    click.echo(f"Archived {moved} messages older than {days} days")
+
+
+def init_app(app):
+    app.config.setdefault('MESSAGE_RETENTION_DAYS', 90)
+    app.cli.add_command(archive_messages_command)
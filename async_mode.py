@@ -0,0 +1,106 @@
+import os
+import functools
+import importlib
+import contextvars
+
+# Which server Socket.IO runs on: 'threading' (default, one OS thread per client)
+# or 'gevent' (cooperative, thousands of idle sockets per process).
+# eventlet is not offered: its tpool threads deadlock on the green-patched locks
+# SQLAlchemy's connection pool uses, so DB work could not be offloaded safely.
+ASYNC_MODE = os.environ.get('FRIENDUS_ASYNC_MODE', 'threading').lower()
+
+# Max number of OS threads doing blocking work (DB queries, file writes) at once
+# when running in a cooperative mode.
+BLOCKING_POOL_SIZE = int(os.environ.get('FRIENDUS_BLOCKING_POOL_SIZE', 20))
+
+_patched = False
+
+
+def monkey_patch():
+    """Patch the stdlib for the selected mode. Must run before flask/sqlalchemy are imported."""
+    global _patched
+    if _patched: return
+    if ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+        import gevent
+        gevent.get_hub().threadpool.maxsize = BLOCKING_POOL_SIZE
+    elif ASYNC_MODE != 'threading':
+        raise ValueError(f"Unknown FRIENDUS_ASYNC_MODE: {ASYNC_MODE!r}")
+    _patched = True
+
+
+def run_blocking(fn, *args, **kwargs):
+    """Run blocking work (SQLAlchemy, disk IO) without stalling the event loop.
+
+    In threading mode the caller already owns a thread, so the call is made directly.
+    In gevent mode the call is handed to the hub's bounded OS thread pool and
+    the current greenlet yields until it finishes. The Flask app/request context is
+    carried over so `db.session` and `current_user` keep working inside `fn`.
+    """
+    if ASYNC_MODE == 'threading':
+        return fn(*args, **kwargs)
+
+    import gevent
+    ctx = contextvars.copy_context()
+    return gevent.get_hub().threadpool.apply(ctx.run, (fn,) + args, kwargs)
+
+
+class _PooledCursor:
+    """DB-API cursor proxy whose blocking calls run on the hub's thread pool."""
+    BLOCKING = frozenset({'execute', 'executemany', 'executescript', 'fetchone', 'fetchmany', 'fetchall', 'close'})
+
+    def __init__(self, cursor):
+        object.__setattr__(self, '_target', cursor)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        return functools.partial(_on_pool, attr) if name in self.BLOCKING else attr
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class _PooledConnection(_PooledCursor):
+    """DB-API connection proxy: cursors it hands out are pooled too, as are commits."""
+    BLOCKING = _PooledCursor.BLOCKING | {'commit', 'rollback'}
+
+    def cursor(self, *args):
+        return _PooledCursor(self._target.cursor(*args))
+
+
+def _on_pool(fn, *args, **kwargs):
+    # Called from a pool thread already (inside run_blocking), gevent runs fn inline
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+
+def offload_dbapi(engine):
+    """In gevent mode, run every DB-API call `engine` makes on the hub's thread pool.
+
+    The sqlite3 driver blocks its whole OS thread, so a query issued from a greenlet
+    (an HTTP view, a user_cache miss, a socket handler) would stall every socket in
+    the process. Proxying the driver's connections moves each execute/fetch/commit to
+    the pool while the rest of the view keeps running on the hub, where it can still
+    spawn greenlets and emit. Connections then hop between pool threads, which pysqlite
+    allows for file databases (SQLAlchemy opens them with check_same_thread=False).
+    No-op in threading mode.
+    """
+    if ASYNC_MODE == 'threading': return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'do_connect')
+    def connect(dialect, conn_rec, cargs, cparams):
+        return _PooledConnection(_on_pool(dialect.connect, *cargs, **cparams))
+
+
+def original(module, name):
+    """A stdlib function as it was before gevent patched it, e.g. original('time', 'sleep').
+    For code that runs in a real OS thread next to the event loop (the sampling profiler)."""
+    if ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    return getattr(importlib.import_module(module), name)
@@ -0,0 +1,112 @@
+"""Concurrency benchmark for the chat Socket.IO server.
+
+Logs in once, then opens N websocket clients spread over rooms of --room-size members
+that sit idle, and finally measures send_message round-trip latency while they are
+connected. The rooms are created (and joined) over HTTP first, since the server
+only lets members join a room's socket channel. Every join broadcasts the user list to the whole room, so very large
+rooms measure fan-out rather than how many idle sockets the process can hold.
+
+    # terminal 1 (every client is the same user, so turn the per-user rate limits off)
+    FRIENDUS_ASYNC_MODE=gevent FRIENDUS_RATE_LIMIT=0 python app.py
+    # terminal 2
+    python bench_socketio.py --email a@b.com --password 123 --clients 2000
+
+Run it against the same machine and settings you compare with (mode, ulimit -n,
+--clients/--room-size): the numbers are only meaningful relative to another run.
+
+Needs: pip install python-socketio aiohttp
+"""
+import re
+import time
+import asyncio
+import argparse
+import statistics
+
+import aiohttp
+import socketio
+
+
+async def csrf_token(http, url):
+    async with http.get(url) as resp:
+        html = await resp.text()
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', html).group(1)
+
+
+async def login(url, email, password, rooms):
+    """Log in, make sure the user is a member of every room, and return the session cookie."""
+    # unsafe=True: keep cookies set by a bare IP host like 127.0.0.1
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as http:
+        data = {'csrf_token': await csrf_token(http, f'{url}/login'), 'email': email, 'password': password}
+        async with http.post(f'{url}/login', data=data, allow_redirects=False) as resp:
+            if resp.status != 302: raise SystemExit('Login failed, check --email/--password')
+
+        token = await csrf_token(http, f'{url}/chat')
+        for room in rooms:
+            # Creating an existing room just fails validation; the GET joins it either way
+            async with http.post(f'{url}/chat', data={'csrf_token': token, 'name': room}, allow_redirects=False):
+                pass
+            async with http.get(f'{url}/chat/{room}') as resp:
+                if resp.status != 200: raise SystemExit(f'Could not join room {room}')
+        return '; '.join(f'{c.key}={c.value}' for c in http.cookie_jar)
+
+
+async def open_client(url, cookie, room, connected):
+    sio = socketio.AsyncClient(reconnection=False)
+    try:
+        await sio.connect(url, headers={'Cookie': cookie}, transports=['websocket'])
+        await sio.emit('join', {'room': room})
+        connected.append(sio)
+    except Exception as e:
+        print(f"connect failed: {e}")
+
+
+async def measure_latency(url, cookie, room, samples):
+    sio = socketio.AsyncClient(reconnection=False)
+    received = asyncio.Queue()
+    sio.on('receive_message', lambda data: received.put_nowait(time.perf_counter()))
+    await sio.connect(url, headers={'Cookie': cookie}, transports=['websocket'])
+    await sio.emit('join', {'room': room})
+    await asyncio.sleep(0.5)
+
+    latencies = []
+    for i in range(samples):
+        start = time.perf_counter()
+        await sio.emit('send_message', {'msg': f'bench {i}', 'room': room})
+        latencies.append((await asyncio.wait_for(received.get(), 10) - start) * 1000)
+    await sio.disconnect()
+    return latencies
+
+
+async def main(args):
+    rooms = [f'{args.room}-{n}' for n in range((args.clients + args.room_size - 1) // args.room_size)]
+    cookie = await login(args.url, args.email, args.password, rooms)
+    connected = []
+    start = time.perf_counter()
+    for i in range(0, args.clients, args.batch):
+        batch = range(i, min(i + args.batch, args.clients))
+        await asyncio.gather(*(open_client(args.url, cookie, rooms[n // args.room_size], connected) for n in batch))
+    ramp = time.perf_counter() - start
+    print(f"connected {len(connected)}/{args.clients} clients in {ramp:.1f}s")
+
+    await asyncio.sleep(args.hold)
+    latencies = await measure_latency(args.url, cookie, rooms[0], args.samples)
+    latencies.sort()
+    print(f"send_message round-trip with {len(connected)} idle clients: "
+          f"p50={statistics.median(latencies):.1f}ms "
+          f"p95={latencies[int(len(latencies) * 0.95) - 1]:.1f}ms max={latencies[-1]:.1f}ms")
+
+    await asyncio.gather(*(c.disconnect() for c in connected))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--room', default='bench')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--room-size', type=int, default=50, help='clients per room')
+    parser.add_argument('--batch', type=int, default=100, help='connections opened at once')
+    parser.add_argument('--hold', type=float, default=5, help='seconds to idle before measuring')
+    parser.add_argument('--samples', type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
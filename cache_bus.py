@@ -0,0 +1,121 @@
+"""Cache invalidation between worker processes.
+
+RoomContext, FavoritesCache, UserCache and the tile index keep their state in each
+process's memory. A write updates the local copy directly and publishes the same
+change here, and every other worker applies it when it arrives. Messages go over the
+transport of SOCKETIO_MESSAGE_QUEUE (Redis, or the prefork launcher's local relay) on a
+channel of their own. Without a queue there is only one process and nothing is sent.
+
+A worker can miss messages: those sent before it subscribed (it was just forked) or
+while its subscription was down. The Redis manager reconnects inside its listener
+without telling anyone, so each worker publishes a numbered hello every
+HEARTBEAT_INTERVAL and watches its own come back. The first one to arrive, or one
+after a gap in the numbers, means messages may have been lost: every cache is reset
+and reloads from the database. The manager waits at least a second before it
+reconnects, which is longer than the interval, so an outage always costs a hello.
+"""
+import os
+import uuid
+import weakref
+import threading
+import traceback
+
+from ext import app_extension
+
+CHANNEL = 'friendus-cache'
+HEARTBEAT_INTERVAL = 0.5
+
+
+class CacheBus:
+    def __init__(self):
+        self.socketio = None
+        self._app = None          # weakref; handlers run in its app context
+        self._manager = None      # a second client manager of the Socket.IO queue's kind
+        self._handlers = {}       # kind -> fn(*args), applies a change made by another worker
+        self._resets = []         # fns that drop everything, for when messages were missed
+        self._host_id = None      # per process: a worker skips what it published itself
+        self._listening = None    # pid the listener runs in
+        self._sent = 0            # number of the last hello published
+        self._seen = None         # number of the last own hello received; None until in sync
+        self._lock = threading.Lock()
+
+    def init_app(self, app, socketio):
+        self.socketio = socketio
+        self._app = weakref.ref(app)
+        server_manager = socketio.server.manager
+        if app.config['SOCKETIO_MESSAGE_QUEUE'] and hasattr(server_manager, '_listen'):
+            # Same class as the Socket.IO queue (Redis, Kafka, local relay...), another channel
+            self._manager = type(server_manager)(app.config['SOCKETIO_MESSAGE_QUEUE'], channel=CHANNEL)
+            self._manager.set_server(socketio.server)
+        else:
+            self._manager = None
+        app.before_request(self.start)
+        app.extensions['cache_bus'] = self
+
+    def subscribe(self, kind, apply, reset):
+        """Run `apply(*args)` for every publish(kind, *args) made by another worker, and
+        `reset()` when this worker may have missed some."""
+        self._handlers[kind] = apply
+        if reset not in self._resets: self._resets.append(reset)
+
+    def publish(self, kind, *args):
+        """Tell the other workers about a change already applied in this one."""
+        if self._manager is None: return
+        self.start()
+        try:
+            self._manager._publish({'kind': kind, 'args': args, 'host_id': self._host_id})
+        except Exception:
+            traceback.print_exc()  # the write itself went through; other workers catch up on their next reset
+
+    # --- Listener ---
+    def start(self):
+        """Start listening in this process, once. Called by the prefork worker on start,
+        and lazily before requests for other servers."""
+        if self._manager is None or self._listening == os.getpid(): return
+        with self._lock:
+            if self._listening == os.getpid(): return
+            self._listening = os.getpid()
+            self._host_id = uuid.uuid4().hex
+            self._seen = None
+        self.socketio.start_background_task(self._listen)
+        self.socketio.start_background_task(self._heartbeat, self._host_id)
+
+    @property
+    def in_sync(self):
+        """True once this worker's own hellos come back; until then it may miss messages."""
+        return self._seen is not None
+
+    def _listen(self):
+        while True:
+            try:
+                for message in self._manager._listen():
+                    try: self._handle(message)
+                    except Exception: traceback.print_exc()
+            except Exception:
+                traceback.print_exc()
+            self._seen = None  # resubscribing; what was sent meanwhile is lost
+            self.socketio.sleep(1)
+
+    def _heartbeat(self, host_id):
+        while self._host_id == host_id:  # a forked child starts its own
+            # Numbered even when publishing fails: that outage shows up as a gap too
+            self._sent += 1
+            self.publish('hello', self._sent)
+            self.socketio.sleep(HEARTBEAT_INTERVAL)
+
+    def _handle(self, message):
+        data = message if isinstance(message, dict) else self._manager.json.loads(message)
+        app = self._app()
+        if app is None: return
+        with app.app_context():
+            if data['kind'] == 'hello':
+                if data['host_id'] != self._host_id: return
+                number = data['args'][0]
+                if self._seen is None or number != self._seen + 1:
+                    for reset in self._resets: reset()
+                self._seen = number
+            elif data['host_id'] != self._host_id and data['kind'] in self._handlers:
+                self._handlers[data['kind']](*data['args'])
+
+
+cache_bus = app_extension('cache_bus')
@@ -0,0 +1,63 @@
+import os
+import json
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+# Every key can be overridden with an environment variable FRIENDUS_<KEY>,
+# parsed according to the type of its default (see from_env).
+DEFAULTS = {
+    'SECRET_KEY': 'a-very-secret-key-that-you-should-change',
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, 'friendus.db'),
+    'USER_CACHE_SIZE': 1024,          # max users kept by load_user
+    'USER_CACHE_TTL': 300,            # seconds
+    'ROOM_CACHE_SIZE': 512,           # rooms whose member lists are kept in memory
+    'FAVORITES_CACHE_SIZE': 1024,     # users whose favorite sets are kept in memory
+    'FAVORITES_BATCH_MAX': 10000,     # max location ids per /api/locations/favorites call
+    'SPLIT_MAX_PARTICIPANTS': 100,    # max participants per /api/room/<id>/split call
+    'ROUTING_MAX_SNAP_METERS': 500,   # activities farther than this from any street get no travel time
+    'TILE_CLUSTER_MAX_ZOOM': 14,      # map tiles above this zoom return single points
+    'COMPRESS_MIN_SIZE': 500,         # bytes; smaller HTML/JSON responses are sent as-is
+    'RATE_LIMIT_ENABLED': True,
+    'RATE_LIMITS': {},                # rule -> (tokens per second, burst); see rate_limit.DEFAULT_RULES
+    'RATE_LIMIT_STORAGE_URL': None,   # e.g. redis://localhost:6379/0; unset = per process
+    'SOCKET_MAX_BACKLOG': 64,         # queued packets before a slow client misses typing/status updates
+    'PROFILING_ENABLED': False,       # off: no profiling hooks installed
+    'PROFILING_ADMINS': frozenset(),  # user ids, comma-separated in the environment
+    'PROFILING_SAMPLER_MAX_SECONDS': 600,  # longest stack sampler run an admin can start
+    'MESSAGE_RETENTION_DAYS': 90,     # `flask archive-messages` moves older messages to cold storage
+    'SOCKETIO_MESSAGE_QUEUE': None,   # redis://... or local://<unix socket> (set by prefork.py)
+    'SOCKETIO_TRANSPORTS': None,      # e.g. websocket; multi-worker mode has no sticky sessions for polling
+    'SQLITE_WAL': False,              # WAL journal so several worker processes can read while one writes
+}
+
+# Names used before the FRIENDUS_<KEY> scheme, still honored
+LEGACY_NAMES = {
+    'RATE_LIMIT_ENABLED': 'FRIENDUS_RATE_LIMIT',
+    'RATE_LIMIT_STORAGE_URL': 'FRIENDUS_RATE_LIMIT_REDIS',
+    'PROFILING_ENABLED': 'FRIENDUS_PROFILING',
+}
+
+
+def _parse(raw, default):
+    if isinstance(default, bool): return raw.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int): return int(raw)
+    if isinstance(default, float): return float(raw)
+    if isinstance(default, dict): return json.loads(raw)
+    if isinstance(default, frozenset): return frozenset(int(v) for v in raw.split(',') if v.strip())
+    return raw
+
+
+def from_env(environ=None):
+    """DEFAULTS with FRIENDUS_* environment overrides applied."""
+    environ = os.environ if environ is None else environ
+    config = dict(DEFAULTS)
+    for key, default in DEFAULTS.items():
+        raw = environ.get(f'FRIENDUS_{key}', environ.get(LEGACY_NAMES.get(key, ''), None))
+        if raw is None: continue
+        try:
+            config[key] = _parse(raw, default)
+        except ValueError:
+            raise ValueError(f"Bad value for FRIENDUS_{key}: {raw!r}")
+    if isinstance(config['SOCKETIO_TRANSPORTS'], str):
+        config['SOCKETIO_TRANSPORTS'] = [t.strip() for t in config['SOCKETIO_TRANSPORTS'].split(',') if t.strip()]
+    return config
@@ -0,0 +1,152 @@
+import io
+import csv
+import heapq
+import itertools
+import click
+from sqlalchemy import select, types
+from sqlalchemy.orm import aliased
+
+import archive
+from ext import db
+from models import Room, User, Outsider, Transaction, Activity, Message
+
+# Rows fetched from the DB cursor (and written as one CSV chunk / Parquet row group) at a time
+CHUNK_SIZE = 2000
+
+KINDS = ('transactions', 'activities', 'messages')
+FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+
+def _query(kind, room):
+    """Column-only SELECT for one kind of room data (no ORM objects are built)."""
+    if kind == 'transactions':
+        sender, receiver = aliased(User), aliased(User)
+        return (select(Transaction.id, Transaction.timestamp, Transaction.type, Transaction.status,
+                       Transaction.amount, Transaction.description,
+                       sender.username.label('sender'), receiver.username.label('receiver'),
+                       Outsider.name.label('outsider'))
+                .join(sender, Transaction.sender_id == sender.id)
+                .outerjoin(receiver, Transaction.receiver_id == receiver.id)
+                .outerjoin(Outsider, Transaction.outsider_id == Outsider.id)
+                .where(Transaction.room_id == room.id)
+                .order_by(Transaction.id))
+    if kind == 'activities':
+        return (select(Activity.id, Activity.name, Activity.location, Activity.price,
+                       Activity.start_time, Activity.end_time, Activity.rating)
+                .where(Activity.room_id == room.id)
+                .order_by(Activity.id))
+    if kind == 'messages':
+        # Outer join, like the archived rows: a message outlives its author's username
+        return (select(Message.id, Message.timestamp, User.username, Message.body)
+                .outerjoin(User, Message.user_id == User.id)
+                .where(Message.room == room.name)
+                .order_by(Message.id))
+    raise ValueError(f"Unknown export kind: {kind!r}")
+
+
+def open_cursor(kind, room, chunk_size=CHUNK_SIZE):
+    """Run the export query on a streaming cursor. Returns (query, iterator of row chunks).
+
+    Messages older than MESSAGE_RETENTION_DAYS live in the archive, so a message export
+    merges the archived segments and the hot table by id.
+    """
+    query = _query(kind, room)
+    result = db.session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+    if kind != 'messages': return query, result.partitions()
+    rows = heapq.merge(archive.archived_rows(room.name), result, key=lambda r: r[0])
+    return query, iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+
+
+def stream_csv(kind, room, chunk_size=CHUNK_SIZE):
+    query, chunks = open_cursor(kind, room, chunk_size)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(query.selected_columns.keys())
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+class _ParquetSink:
+    """Write-only file object: ParquetWriter writes into it, the generator drains it."""
+
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self): return self.pos
+    def flush(self): pass
+    def close(self): self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_type(pa, sql_type):
+    if isinstance(sql_type, types.Integer): return pa.int64()
+    if isinstance(sql_type, types.Float): return pa.float64()
+    if isinstance(sql_type, types.DateTime): return pa.timestamp('us')
+    return pa.string()
+
+
+def stream_parquet(kind, room, chunk_size=CHUNK_SIZE):
+    """One Parquet row group per chunk; bytes are yielded as soon as each group is written."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+
+    query, chunks = open_cursor(kind, room, chunk_size)
+    # Schema comes from the column types, so a chunk of all-NULL values can't change it
+    schema = pa.schema([(c.name, _arrow_type(pa, c.type)) for c in query.selected_columns])
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    for rows in chunks:
+        columns = zip(*rows)
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_export(kind, room, fmt, chunk_size=CHUNK_SIZE):
+    if kind not in KINDS: raise ValueError(f"Unknown export kind: {kind!r}")
+    if fmt == 'csv': return stream_csv(kind, room, chunk_size)
+    if fmt == 'parquet': return stream_parquet(kind, room, chunk_size)
+    raise ValueError(f"Unknown export format: {fmt!r}")
+
+
+# --- CLI: flask --app app export-room <room> <kind> ---
+@click.command('export-room')
+@click.argument('room_name')
+@click.argument('kind', type=click.Choice(KINDS))
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Output file (default: <room>-<kind>.<format>)')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True)
+def export_room_command(room_name, kind, fmt, output, chunk_size):
+    """Export a room's transactions, activities or messages to CSV or Parquet."""
+    room = Room.query.filter_by(name=room_name).first()
+    if not room: raise click.ClickException(f"No room named {room_name!r}")
+    output = output or f"{room_name}-{kind}.{fmt}"
+    mode, kwargs = ('w', {'newline': '', 'encoding': 'utf-8'}) if fmt == 'csv' else ('wb', {})
+    with open(output, mode, **kwargs) as f:
+        for chunk in stream_export(kind, room, fmt, chunk_size):
+            f.write(chunk)
+    click.echo(f"Wrote {output}")
+
+
+def init_app(app):
+    app.cli.add_command(export_room_command)
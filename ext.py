@@ -1,5 +1,7 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from werkzeug.local import LocalProxy
 
 # Create extension instances
 db = SQLAlchemy()
@@ -7,4 +9,13 @@ login_manager = LoginManager()
 
 # Configure login manager
 login_manager.login_view = 'login'
-login_manager.login_message_category = 'info'
\ No newline at end of file
+login_manager.login_message_category = 'info'
+
+
+def app_extension(name):
+    """Module-level handle on the instance create_app() stored in app.extensions[name].
+
+    Caches, limiters and the Socket.IO server are made per app, so two apps with
+    different configs or databases can live in one process (tests, tools).
+    """
+    return LocalProxy(lambda: current_app.extensions[name])
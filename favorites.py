@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+from sqlalchemy import func
+
+from ext import db, app_extension
+from models import user_favorites
+
+# Stay under SQLite's limit on bound parameters per statement
+IN_CHUNK = 500
+
+
+def _insert_ignore():
+    """INSERT that silently skips rows already present (favoriting twice is a no-op)."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(user_favorites).on_conflict_do_nothing()
+
+
+class FavoritesCache:
+    """Each user's set of favorite location ids, loaded with one query and kept in an LRU."""
+
+    def __init__(self, max_users=1024):
+        self.max_users = max_users
+        self._sets = OrderedDict()  # user_id -> frozenset of location ids
+        self._versions = {}         # user_id -> int, bumped by invalidate()
+        self._generation = 0        # bumped by clear()
+        self._lock = threading.Lock()
+        self.bus = None
+
+    def init_app(self, app):
+        self.max_users = app.config.get('FAVORITES_CACHE_SIZE', self.max_users)
+        app.extensions['favorites'] = self
+        self.bus = app.extensions['cache_bus']
+        self.bus.subscribe('favorites', self._drop, self.clear)
+
+    def get(self, user_id):
+        with self._lock:
+            ids = self._sets.get(user_id)
+            if ids is not None:
+                self._sets.move_to_end(user_id)
+                return ids
+            version, generation = self._versions.get(user_id, 0), self._generation
+        rows = db.session.query(user_favorites.c.location_id).filter(user_favorites.c.user_id == user_id).all()
+        ids = frozenset(r[0] for r in rows)
+        with self._lock:
+            # Skip caching if a write invalidated the user during the load; the next lookup retries
+            if self._versions.get(user_id, 0) == version and self._generation == generation:
+                self._sets[user_id] = ids
+                while len(self._sets) > self.max_users:
+                    self._sets.popitem(last=False)
+        return ids
+
+    def invalidate(self, user_id):
+        """Drop the user's set here and in the other workers."""
+        self._drop(user_id)
+        self.bus.publish('favorites', user_id)
+
+    def _drop(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._sets.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._sets.clear()
+
+    # --- Idempotent writes: no read-before-write, rowcount tells if anything changed ---
+    # Both run in the caller's transaction; call invalidate(user_id) after it commits.
+    def add(self, user_id, location_id):
+        result = db.session.execute(_insert_ignore().values(user_id=user_id, location_id=location_id))
+        return result.rowcount > 0
+
+    def remove(self, user_id, location_id):
+        result = db.session.execute(user_favorites.delete().where(
+            user_favorites.c.user_id == user_id, user_favorites.c.location_id == location_id
+        ))
+        return result.rowcount > 0
+
+    # --- Batch lookups ---
+    def counts(self, location_ids):
+        """How many users favorited each location: {location_id: n} (0 when nobody did)."""
+        location_ids = list(set(location_ids))
+        counts = dict.fromkeys(location_ids, 0)
+        for i in range(0, len(location_ids), IN_CHUNK):
+            chunk = location_ids[i:i + IN_CHUNK]
+            rows = db.session.query(user_favorites.c.location_id, func.count()) \
+                .filter(user_favorites.c.location_id.in_(chunk)) \
+                .group_by(user_favorites.c.location_id).all()
+            counts.update(rows)
+        return counts
+
+    def status(self, user_id, location_ids):
+        """Favorite flag for `user_id` and popularity count for every location id."""
+        mine = self.get(user_id)
+        return {loc_id: {'favorited': loc_id in mine, 'favorites': n}
+                for loc_id, n in self.counts(location_ids).items()}
+
+
+favorites = app_extension('favorites')
@@ -0,0 +1,104 @@
+import math
+
+from ext import db
+from models import Transaction, Outsider
+
+MODES = ('equal', 'shares', 'exact')
+MAX_AMOUNT = 10 ** 12  # far above any real bill, and exact in cents as a float
+
+
+def _number(value, what):
+    # JSON numbers only: no strings, booleans, NaN/Infinity or amounts that overflow cents
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or abs(value) > MAX_AMOUNT:
+        raise ValueError(f"{what} must be a number up to {MAX_AMOUNT:,}")
+    return value
+
+
+def _id(value, what):
+    if isinstance(value, bool) or not isinstance(value, int): raise ValueError(f"{what} must be an integer id")
+    return value
+
+
+def _cents(value, what='amount'):
+    return int(round(_number(value, what) * 100))
+
+
+def split_amounts(total, mode, participants):
+    """Each participant's part of `total`, in participant order.
+
+    'equal' splits evenly, 'shares' by each participant's `shares` weight, 'exact' takes
+    each `amount` as given (they must add up to the total). Parts are whole cents and
+    always sum to the total: leftover cents go to the largest remainders first.
+    """
+    if mode not in MODES: raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    if not participants: raise ValueError('at least one participant is required')
+    total_c = _cents(total, 'total')
+    if total_c <= 0: raise ValueError('total must be positive')
+
+    if mode == 'exact':
+        parts = [_cents(p.get('amount', 0), 'amount') for p in participants]
+        if any(c < 0 for c in parts): raise ValueError('amounts cannot be negative')
+        if sum(parts) != total_c: raise ValueError('amounts must add up to the total')
+        return [c / 100 for c in parts]
+
+    weights = [1.0] * len(participants) if mode == 'equal' else [float(_number(p.get('shares', 1), 'shares')) for p in participants]
+    if any(w < 0 for w in weights) or not sum(weights): raise ValueError('shares must be non-negative and not all zero')
+    exact = [total_c * w / sum(weights) for w in weights]
+    parts = [int(e) for e in exact]
+    by_remainder = sorted(range(len(exact)), key=lambda i: exact[i] - parts[i], reverse=True)
+    for i in by_remainder[:total_c - sum(parts)]:
+        parts[i] += 1
+    return [c / 100 for c in parts]
+
+
+def resolve_outsiders(creator_id, names):
+    """name -> Outsider for `creator_id`, with one query; missing ones are added to the
+    session (not committed) so they are inserted with the caller's transaction."""
+    names = set(names)
+    if not names: return {}
+    found = {o.name: o for o in Outsider.query.filter(Outsider.creator_id == creator_id, Outsider.name.in_(names))}
+    new = [Outsider(name=n, creator_id=creator_id) for n in names - found.keys()]
+    db.session.add_all(new)
+    found.update((o.name, o) for o in new)
+    return found
+
+
+def build_split(room, creator_id, payer_id, total, mode, participants, description):
+    """Transaction rows for one expense `payer_id` paid for `participants`, added to the session.
+
+    A participant is {'user_id': <room member>} or {'outsider': <name>}, plus 'shares' or
+    'amount' depending on `mode`. The payer's own part and zero parts produce no row.
+    Each row is recorded as the payer having paid that participant's part, which is how
+    the debt graph already nets "X owes payer". Members confirm theirs as with any
+    transaction; outsiders are confirmed right away, as in the single-transaction form.
+    """
+    if _id(payer_id, 'payer_id') not in room.members: raise ValueError('payer must be a room member')
+    keys = []
+    for p in participants:
+        outsider = p.get('outsider')
+        if p.get('user_id') is not None:
+            key = ('user', _id(p['user_id'], 'user_id'))
+            if key[1] not in room.members: raise ValueError(f"user {key[1]} is not a member of this room")
+        elif isinstance(outsider, str) and outsider.strip():
+            key = ('outsider', outsider.strip()[:100])
+        else:
+            raise ValueError("each participant needs a user_id or an outsider name")
+        if key in keys: raise ValueError('participants must be unique')
+        keys.append(key)
+
+    parts = split_amounts(total, mode, participants)
+    outsiders = resolve_outsiders(creator_id, [name for kind, name in keys if kind == 'outsider'])
+    rows = []
+    for (kind, who), amount in zip(keys, parts):
+        if amount <= 0 or (kind == 'user' and who == payer_id): continue
+        # Every row sets the same columns, so the flush sends them as one batched INSERT
+        trans = Transaction(amount=amount, description=description, type='repayment',
+                            sender_id=payer_id, room_id=room.id, status='pending', receiver_id=None, outsider_id=None)
+        if kind == 'user':
+            trans.receiver_id = who
+        else:
+            trans.outsider = outsiders[who]
+            trans.status = 'confirmed'
+        rows.append(trans)
+    db.session.add_all(rows)
+    return rows
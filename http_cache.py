@@ -0,0 +1,159 @@
+import os
+import gzip
+import time
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from flask import request, session, make_response, current_app, g
+from flask_login import current_user
+from sqlalchemy import and_, or_
+
+from ext import db, app_extension
+from models import EntityVersion
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+                'application/javascript', 'application/json'}
+
+# Part of every validator: usernames show up in the navbar, posts, reviews and graphs
+GLOBAL_STAMPS = (('users', 0),)
+
+
+def _upsert():
+    """INSERT of a version row that bumps it instead when it already exists."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(EntityVersion)
+    return stmt.on_conflict_do_update(
+        index_elements=['kind', 'entity_id'],
+        set_={'version': EntityVersion.version + 1, 'updated_at': stmt.excluded.updated_at}
+    )
+
+
+class HttpCache:
+    """Conditional GET from per-entity version stamps, plus gzip/brotli response compression.
+
+    Writers call bump() before their commit; views wrapped in @conditional answer
+    304 from the stamps alone, without running the view body.
+
+    HTML that embeds a CSRF token is never compressed (BREACH): pages also echo
+    attacker-chosen text such as ?query=, and the compressed size would leak the token
+    a few bytes at a time. JSON, assets and token-free pages are still compressed.
+    """
+
+    def __init__(self, min_size=500, gzip_level=6, brotli_quality=4):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.build_id = ''
+
+    def init_app(self, app):
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        self.gzip_level = app.config.get('COMPRESS_GZIP_LEVEL', self.gzip_level)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', self.brotli_quality)
+        # Templates and code change on deploy; same on every worker, unlike a random id
+        sources = [os.path.join(app.root_path, 'templates'), app.root_path]
+        mtimes = [os.path.getmtime(os.path.join(d, f)) for d in sources for f in os.listdir(d)
+                  if f.endswith(('.html', '.py'))]
+        self.build_id = str(int(max(mtimes, default=0)))
+        app.after_request(self.compress)
+        app.extensions['http_cache'] = self
+
+    # --- Version stamps ---
+    def bump(self, kind, entity_id):
+        self.bump_many(kind, [entity_id])
+
+    def bump_many(self, kind, entity_ids):
+        """Queue version bumps in the current transaction; they land with the caller's commit."""
+        now = datetime.utcnow()
+        rows = [{'kind': kind, 'entity_id': i, 'version': 1, 'updated_at': now} for i in set(entity_ids)]
+        if rows: db.session.execute(_upsert(), rows)
+
+    def stamps(self, keys):
+        """{(kind, id): (version, updated_at)} for the keys that have ever been bumped."""
+        conditions = [and_(EntityVersion.kind == kind, EntityVersion.entity_id == i) for kind, i in keys]
+        rows = db.session.query(EntityVersion.kind, EntityVersion.entity_id, EntityVersion.version, EntityVersion.updated_at) \
+            .filter(or_(*conditions)).all()
+        return {(kind, i): (version, updated_at) for kind, i, version, updated_at in rows}
+
+    def validators(self, keys):
+        """(weak ETag, Last-Modified) for the current request and user over the given stamps."""
+        keys = sorted(set(keys) | set(GLOBAL_STAMPS))
+        stamps = self.stamps(keys)
+        # Pages embed a CSRF token: change the validator when it would stop being accepted
+        csrf_window = max(60, (current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) // 2)
+        epoch = int(time.time()) // csrf_window
+        parts = [self.build_id, request.full_path, str(current_user.get_id()), session.get('csrf_token', ''), str(epoch)]
+        parts += [f"{kind}:{i}:{stamps.get((kind, i), (0,))[0]}" for kind, i in keys]
+        etag = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:24]
+
+        changed = [updated_at for _, updated_at in stamps.values()]
+        changed.append(datetime.fromtimestamp(epoch * csrf_window, timezone.utc).replace(tzinfo=None))
+        last_modified = max(changed).replace(microsecond=0, tzinfo=timezone.utc)
+        return etag, last_modified
+
+    # --- Compression ---
+    def compress(self, response):
+        if (response.status_code != 200 or request.method == 'HEAD' or response.direct_passthrough
+                or response.is_streamed or response.mimetype not in COMPRESSIBLE
+                or 'Content-Encoding' in response.headers):
+            return response
+        # Flask-WTF keeps the token it rendered into this response in g (see class docstring)
+        if response.mimetype == 'text/html' and current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token') in g:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size: return response
+
+        response.vary.add('Accept-Encoding')
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            body, coding = brotli.compress(data, quality=self.brotli_quality), 'br'
+        elif accepted['gzip']:
+            body, coding = gzip.compress(data, self.gzip_level, mtime=0), 'gzip'
+        else:
+            return response
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = coding
+        # A strong ETag names exact bytes; the compressed body is a different representation
+        etag, weak = response.get_etag()
+        if etag and not weak: response.set_etag(etag, weak=True)
+        return response
+
+
+def conditional(keys_for):
+    """Decorator for GET views. keys_for(**view_args) lists the (kind, id) stamps the page
+    is built from; returning None skips validation (e.g. let the view 404)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # Pending flash messages must be rendered, so never answer those with a 304
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'): return view(**kwargs)
+            keys = keys_for(**kwargs)
+            if keys is None: return view(**kwargs)
+
+            etag, last_modified = http_cache.validators(keys)
+            if request.if_none_match:
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                fresh = request.if_modified_since is not None and last_modified <= request.if_modified_since
+            if fresh:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200: return response
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+http_cache = app_extension('http_cache')
@@ -95,12 +95,27 @@ class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    room = db.Column(db.String(50), nullable=False) 
+    room = db.Column(db.String(50), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     def __repr__(self):
         return f"Message('{self.body}', '{self.author.username}')"
 
+# --- Cold storage for old messages (see archive.py) ---
+class MessageArchive(db.Model):
+    # One row = one zlib-compressed JSON segment of consecutive messages of a room
+    id = db.Column(db.Integer, primary_key=True)
+    room = db.Column(db.String(50), nullable=False, index=True)
+    first_id = db.Column(db.Integer, nullable=False)  # Message ids covered, inclusive
+    last_id = db.Column(db.Integer, nullable=False, index=True)
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f"<MessageArchive {self.room} {self.first_id}-{self.last_id}>"
+
 # --- PHẦN FINANCE MỚI ---
 
 class Outsider(db.Model):
@@ -110,6 +125,9 @@ class Outsider(db.Model):
     creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     creator = db.relationship('User', backref='outsiders')
 
+    # Outsiders are always looked up by name within one creator's contacts
+    __table_args__ = (db.Index('ix_outsider_creator_name', 'creator_id', 'name'),)
+
     def __repr__(self):
         return f"<Outsider {self.name}>"
 
@@ -174,4 +192,27 @@ class Constraint(db.Model):
     user = db.relationship('User', backref='constraints')
 
     def __repr__(self):
-        return f"<Constraint {self.type} {self.intensity}>"
\ No newline at end of file
+        return f"<Constraint {self.type} {self.intensity}>"
+
+
+# --- Version stamps for HTTP validators (see http_cache.py) ---
+class EntityVersion(db.Model):
+    # Bumped in the same transaction as the write; pages build their ETag from these
+    kind = db.Column(db.String(30), primary_key=True)  # 'location', 'user_posts', 'room_transactions', 'users'
+    entity_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<EntityVersion {self.kind}:{self.entity_id} v{self.version}>"
+
+# --- Who is connected to which chat room (see presence.py) ---
+class RoomPresence(db.Model):
+    # One row per joined socket, so every worker process sees the same user lists
+    sid = db.Column(db.String(64), primary_key=True)
+    room = db.Column(db.String(50), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)  # usernames can change
+    worker = db.Column(db.String(100), nullable=False, index=True)  # host:pid of the process holding the socket
+
+    def __repr__(self):
+        return f"<RoomPresence user {self.user_id} in {self.room}>"
@@ -0,0 +1,215 @@
+import os
+import math
+import click
+from flask import current_app
+from sqlalchemy import insert, update, func, bindparam
+
+from ext import db
+from models import Location
+from http_cache import http_cache
+
+# OSM keys that make something a point of interest, in the order used to pick Location.type
+DEFAULT_TAGS = {'amenity': True, 'tourism': True, 'shop': True, 'leisure': True}
+
+# Two rows with the same name closer than this are the same place
+DEFAULT_RADIUS_M = 75
+CHUNK_SIZE = 5000
+
+# On a matched Location these are only filled in where empty: a hand-entered
+# description or type ('Custom') is never replaced by the OSM one.
+FILL_IF_EMPTY = ('description', 'type', 'hours', 'phone', 'website')
+POSITION = ('latitude', 'longitude')  # a placed pin stays put unless --update-positions
+
+
+def _fill_update(update_positions=False):
+    # Core executemany; bind names can't reuse column names in an UPDATE's SET clause
+    loc = Location.__table__
+    values = {c: func.coalesce(func.nullif(loc.c[c], ''), bindparam(f'_{c}')) for c in FILL_IF_EMPTY}
+    if update_positions: values.update({c: bindparam(f'_{c}') for c in POSITION})
+    return update(loc).where(loc.c.id == bindparam('_id')).values(**values)
+
+
+def configure_osmnx(cache_folder):
+    """Point osmnx at the project's cache/ so previously downloaded Overpass responses are reused."""
+    import osmnx as ox
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = cache_folder
+    return ox
+
+
+def fetch_features(cache_folder, place=None, bbox=None, tags=None):
+    """GeoDataFrame of OSM features for a place name or a (west, south, east, north) bbox."""
+    ox = configure_osmnx(cache_folder)
+    tags = tags or DEFAULT_TAGS
+    if place: return ox.features_from_place(place, tags)
+    return ox.features_from_bbox(bbox, tags)
+
+
+def _distance_m(lat1, lon1, lat2, lon2):
+    # Equirectangular approximation, plenty for "is this the same place" checks
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000 * math.hypot(x, y)
+
+
+def _clean(value, max_len):
+    # GeoDataFrame cells are NaN (a float) where a tag is missing
+    if not isinstance(value, str) or not value.strip(): return None
+    return value.strip()[:max_len]
+
+
+def location_rows(gdf, tags=None):
+    """Turn OSM features into dicts with Location's columns. Unnamed features are skipped."""
+    tag_keys = list(tags or DEFAULT_TAGS)
+    columns = set(gdf.columns)
+
+    def col(name):
+        return gdf[name].tolist() if name in columns else [None] * len(gdf)
+
+    points = gdf.geometry.representative_point()
+    names = col('name')
+    kinds = [col(k) for k in tag_keys]
+    hours, phones, websites = col('opening_hours'), col('phone'), col('website')
+    contact_phones, contact_sites = col('contact:phone'), col('contact:website')
+    streets, numbers, cities = col('addr:street'), col('addr:housenumber'), col('addr:city')
+
+    for i, point in enumerate(points):
+        name = _clean(names[i], 100)
+        if not name or point is None or point.is_empty: continue
+
+        kind = next((_clean(k[i], 50) for k in kinds if _clean(k[i], 50)), None)
+        street = _clean(streets[i], 100)
+        address = ', '.join(p for p in (_clean(numbers[i], 20), street, _clean(cities[i], 100)) if p)
+        yield {
+            'name': name,
+            'description': f"Address: {address}" if address else f"{(kind or 'Place').replace('_', ' ').title()} from OpenStreetMap",
+            'latitude': point.y,
+            'longitude': point.x,
+            'type': kind.replace('_', ' ').title() if kind else None,
+            'hours': _clean(hours[i], 100),
+            'phone': _clean(phones[i], 20) or _clean(contact_phones[i], 20),
+            'website': _clean(websites[i], 100) or _clean(contact_sites[i], 100),
+            'street': street,  # only used to disambiguate names, not a Location column
+        }
+
+
+class _ExistingIndex:
+    """In-memory name -> [(id, lat, lon)] of every Location, loaded with one query."""
+
+    def __init__(self):
+        self.by_name = {}
+        for loc_id, name, lat, lon in db.session.query(Location.id, Location.name, Location.latitude, Location.longitude):
+            self.by_name.setdefault(name, []).append((loc_id, lat, lon))
+
+    @staticmethod
+    def candidate_names(row):
+        """Location.name is unique, so a same-named place elsewhere (a chain store...) gets a
+        suffix: the street if known, else its coordinates. Deterministic, so re-imports match."""
+        name = row['name']
+        names = [name]
+        if row.get('street'): names.append(f"{name} ({row['street']})"[:100])
+        names.append(f"{name} ({row['latitude']:.4f}, {row['longitude']:.4f})"[:100])
+        return names
+
+    def match(self, row, radius_m):
+        """Id of a Location for this place (0 if it came earlier in this batch), or None."""
+        for name in self.candidate_names(row):
+            for loc_id, lat, lon in self.by_name.get(name, ()):
+                if _distance_m(lat, lon, row['latitude'], row['longitude']) <= radius_m:
+                    return loc_id
+        return None
+
+    def free_name(self, row):
+        return next((n for n in self.candidate_names(row) if n not in self.by_name), None)
+
+    def add(self, loc_id, row, name):
+        self.by_name.setdefault(name, []).append((loc_id, row['latitude'], row['longitude']))
+
+
+def import_locations(rows, radius_m=DEFAULT_RADIUS_M, chunk_size=CHUNK_SIZE, progress=None, dry_run=False,
+                     update_positions=False):
+    """Upsert Location rows in chunks. Returns {'inserted', 'updated', 'skipped'} counts.
+
+    A row matching an existing Location by name within `radius_m` updates that Location:
+    only the FILL_IF_EMPTY fields it doesn't have yet, so hand-entered data is never
+    blanked or overwritten. Its position moves to the OSM one only with update_positions;
+    the tile index picks the move up from the 'location' version bump.
+    Everything else is bulk-inserted, one commit per chunk.
+    """
+    index = _ExistingIndex()
+    stats = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    inserts, updates = [], []
+    seen = 0
+
+    def flush():
+        nonlocal seen
+        if not dry_run:
+            # executemany INSERT, and SQLAlchemy's bulk UPDATE by primary key
+            if inserts: db.session.execute(insert(Location), inserts)
+            if updates:
+                db.session.execute(_fill_update(update_positions), updates)
+                http_cache.bump_many('location', [u['_id'] for u in updates])
+            db.session.commit()
+        stats['inserted'] += len(inserts)
+        stats['updated'] += len(updates)
+        if progress: progress(seen)
+        inserts.clear()
+        updates.clear()
+        seen = 0
+
+    for row in rows:
+        seen += 1
+        loc_id = index.match(row, radius_m)
+        fields = {k: v for k, v in row.items() if k != 'street'}
+        if loc_id == 0:
+            stats['skipped'] += 1  # duplicate inside the OSM data itself
+        elif loc_id:
+            updates.append({'_id': loc_id, **{f'_{k}': fields[k] for k in FILL_IF_EMPTY + POSITION}})
+        else:
+            name = index.free_name(row)
+            if name:
+                index.add(0, row, row['name'])
+                index.add(0, row, name)
+                inserts.append({**fields, 'name': name})
+            else:
+                stats['skipped'] += 1
+        if seen >= chunk_size: flush()
+    flush()
+    return stats
+
+
+# --- CLI: flask --app app import-osm --place "Hoan Kiem, Hanoi" ---
+@click.command('import-osm')
+@click.option('--place', help='Place name to geocode, e.g. "Hoan Kiem, Hanoi"')
+@click.option('--bbox', help='west,south,east,north in degrees')
+@click.option('--tags', default=','.join(DEFAULT_TAGS), show_default=True, help='OSM keys to import')
+@click.option('--radius', type=float, default=DEFAULT_RADIUS_M, show_default=True, help='Dedupe radius in meters')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True)
+@click.option('--update-positions', is_flag=True, help='Move matched locations to the OSM position')
+@click.option('--dry-run', is_flag=True, help='Resolve everything but write nothing')
+def import_osm_command(place, bbox, tags, radius, chunk_size, update_positions, dry_run):
+    """Bulk-import OpenStreetMap points of interest into Location."""
+    if bool(place) == bool(bbox): raise click.UsageError('Give exactly one of --place or --bbox')
+    if bbox:
+        try:
+            bbox = tuple(float(v) for v in bbox.split(','))
+            if len(bbox) != 4: raise ValueError
+        except ValueError:
+            raise click.BadParameter('expected four numbers: west,south,east,north', param_hint='--bbox')
+    tags = {t.strip(): True for t in tags.split(',') if t.strip()}
+
+    cache_folder = os.path.join(current_app.root_path, 'cache')
+    click.echo(f"Fetching OSM features (cache: {cache_folder})...")
+    gdf = fetch_features(cache_folder, place=place, bbox=bbox, tags=tags)
+    rows = list(location_rows(gdf, tags))
+    click.echo(f"{len(gdf)} features, {len(rows)} named points of interest")
+
+    with click.progressbar(length=len(rows), label='Importing') as bar:
+        stats = import_locations(rows, radius_m=radius, chunk_size=chunk_size, progress=bar.update, dry_run=dry_run,
+                                 update_positions=update_positions)
+    click.echo(f"Inserted {stats['inserted']}, updated {stats['updated']}, skipped {stats['skipped']}"
+               + (' (dry run, nothing written)' if dry_run else ''))
+
+
+def init_app(app):
+    app.cli.add_command(import_osm_command)
@@ -0,0 +1,314 @@
+"""Pre-fork launcher: build the app once, then fork one server process per core.
+
+    FRIENDUS_ASYNC_MODE=gevent python prefork.py --workers 4 --port 5000
+
+The parent imports everything, creates the tables and warms the read-mostly
+in-memory indexes (map tiles, routing graph) before forking, so the workers
+share those pages copy-on-write. All workers accept on one listening socket.
+Socket.IO events reach clients on other workers through SOCKETIO_MESSAGE_QUEUE;
+when none is configured the parent relays them itself over a Unix socket
+(local://...), which is enough for a single node. The in-memory caches follow each
+other's writes over the same transport (cache_bus.py), and room presence is kept in
+the database (presence.py).
+"""
+# --- Async Mode (must patch the stdlib before anything else is imported) ---
+import async_mode
+async_mode.monkey_patch()
+
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import socketio
+
+LOCAL_SCHEME = 'local://'
+_HEADER = struct.Struct('!I')  # every relayed message is <length><json>
+
+
+def _recv_exact(sock, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk: raise ConnectionError('message relay closed the connection')
+        buf += chunk
+    return buf
+
+
+# --- Worker side: Socket.IO client manager ---
+class LocalManager(socketio.PubSubManager):
+    """Socket.IO message queue for the workers of one node, in place of Redis.
+
+    Publishes to and listens on the launcher's Relay at local://<unix socket path>.
+    Like the Redis manager, every worker gets every message of its channel and skips its own.
+    """
+
+    name = 'local'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = url[len(LOCAL_SCHEME):]
+        self._pub = None
+        self._pub_lock = threading.Lock()
+
+    def _connect(self, role):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(role + self.channel.encode('utf-8') + b'\n')
+        return sock
+
+    def _publish(self, data):
+        frame = self.json.dumps(data).encode('utf-8')
+        with self._pub_lock:
+            for retries_left in (1, 0):
+                try:
+                    if self._pub is None: self._pub = self._connect(b'P')
+                    self._pub.sendall(_HEADER.pack(len(frame)) + frame)
+                    return
+                except OSError:
+                    self._pub = None
+                    if not retries_left: raise
+
+    def _listen(self):
+        try:
+            sock = self._connect(b'S')
+        except OSError:
+            self.server.sleep(1)  # relay not up (yet); PubSubManager retries
+            raise
+        while True:
+            size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+            yield _recv_exact(sock, size)
+
+
+# --- Parent side: the relay ---
+class Relay:
+    """Copies each message a worker publishes to every worker listening on the same channel.
+
+    A connection starts with a role byte (P publishes, S subscribes) and the channel
+    name ending in a newline.
+
+    Driven by poll() from the launcher's supervise loop, or serve_forever() in a thread
+    when several apps in one process share it (see tests/test_app_factory.py).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen(128)
+        self._new = set()          # connected, role byte not read yet
+        self._publishers = {}      # sock -> (channel, bytearray of partial frames)
+        self._subscribers = {}     # sock -> channel
+
+    def poll(self, timeout):
+        try:
+            readable, _, _ = select.select([self.listener, *self._new, *self._publishers], [], [], timeout)
+        except InterruptedError:
+            return
+        for sock in readable:
+            if sock is self.listener:
+                conn, _ = self.listener.accept()
+                self._new.add(conn)
+            elif sock in self._new:
+                self._new.discard(sock)
+                role, channel = self._handshake(sock)
+                if role == b'P': self._publishers[sock] = (channel, bytearray())
+                elif role == b'S': self._subscribers[sock] = channel
+                else: sock.close()
+            else:
+                self._read(sock)
+
+    @staticmethod
+    def _handshake(sock):
+        # Sent in one write right after connecting, before any frame
+        try:
+            role, line = sock.recv(1), b''
+            while not line.endswith(b'\n') and len(line) < 256:
+                byte = sock.recv(1)
+                if not byte: break
+                line += byte
+        except OSError:
+            return None, None
+        return role, line.rstrip(b'\n')
+
+    def serve_forever(self):
+        while self.listener.fileno() != -1:
+            self.poll(1.0)
+
+    def _read(self, sock):
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            del self._publishers[sock]
+            sock.close()
+            return
+        channel, buf = self._publishers[sock]
+        buf += data
+        while len(buf) >= _HEADER.size:
+            size, = _HEADER.unpack_from(buf)
+            if len(buf) < _HEADER.size + size: break
+            frame = bytes(buf[:_HEADER.size + size])
+            del buf[:_HEADER.size + size]
+            self._broadcast(frame, channel)
+
+    def _broadcast(self, frame, channel):
+        for sub, sub_channel in list(self._subscribers.items()):
+            if sub_channel != channel: continue
+            try:
+                sub.sendall(frame)
+            except OSError:  # that worker is gone
+                del self._subscribers[sub]
+                sub.close()
+
+    def detach(self):
+        """Close the relay's sockets in a forked worker (the parent keeps serving)."""
+        for sock in (self.listener, *self._new, *self._publishers, *self._subscribers):
+            sock.close()
+
+    def close(self):
+        self.detach()
+        try:
+            os.unlink(self.path)
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass
+
+
+# --- Launcher ---
+def warm_up(app):
+    """Work done once in the parent so every worker inherits it copy-on-write."""
+    from app import populate_db
+    from ext import db
+    from tiles import tile_index
+    import routing
+    import presence
+    with app.app_context():
+        db.create_all()
+        populate_db()
+        presence.clear_host()  # sockets of a previous run on this host are gone
+        tile_index.refresh()
+        routing.get_graph()
+        # The parent never serves requests: no pooled connection may cross the fork
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def run_worker(app, listener):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops workers with SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if async_mode.ASYNC_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        from geventwebsocket.handler import WebSocketHandler
+        WSGIServer(listener, app, handler_class=WebSocketHandler, log=None).serve_forever()
+    else:
+        from werkzeug.serving import make_server
+        host, port = listener.getsockname()[:2]
+        make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+
+def spawn(app, listener, relay):
+    pid = os.fork()
+    if pid: return pid
+    code = 0
+    try:
+        if relay: relay.detach()
+        app.extensions['cache_bus'].start()  # resets the caches inherited from the parent once subscribed
+        run_worker(app, listener)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def forget_worker(app, pid):
+    """Remove a dead worker's sockets from the room user lists."""
+    from ext import db
+    import presence
+    with app.app_context():
+        try:
+            presence.clear_worker(pid)
+        finally:
+            for engine in db.engines.values():
+                engine.dispose()
+
+
+def main(argv=None):
+    from config import from_env
+
+    parser = argparse.ArgumentParser(description='Run the app in several pre-forked worker processes.')
+    parser.add_argument('-w', '--workers', type=int, default=int(os.environ.get('FRIENDUS_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    env = from_env()
+    config = {'SQLITE_WAL': True}
+    relay = None
+    if args.workers > 1:
+        # Long-polling needs every request of a session on the same worker; websockets don't
+        if not env['SOCKETIO_TRANSPORTS']: config['SOCKETIO_TRANSPORTS'] = ['websocket']
+        if not env['SOCKETIO_MESSAGE_QUEUE']:
+            relay = Relay(os.path.join(tempfile.mkdtemp(prefix='friendus-'), 'socketio.sock'))
+            config['SOCKETIO_MESSAGE_QUEUE'] = LOCAL_SCHEME + relay.path
+
+    from app import create_app
+    app = create_app(config)
+    warm_up(app)
+    listener = socket.create_server((args.host, args.port), backlog=2048)
+
+    workers = {spawn(app, listener, relay) for _ in range(args.workers)}
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} workers "
+          f"({async_mode.ASYNC_MODE}, message queue: {app.config['SOCKETIO_MESSAGE_QUEUE'] or 'none'})")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        if relay: relay.poll(0.5)
+        else: time.sleep(0.5)
+        # Replace workers that died
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if not pid: break
+            workers.discard(pid)
+            forget_worker(app, pid)
+            if not stopping:
+                print(f"Worker {pid} exited ({status}); starting a new one", file=sys.stderr)
+                time.sleep(1)
+                workers.add(spawn(app, listener, relay))
+
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH: raise
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    listener.close()
+    if relay: relay.close()
+
+
+if __name__ == '__main__':
+    main()
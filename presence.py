@@ -0,0 +1,59 @@
+"""Chat room presence, kept in the database so it is shared by every worker process.
+
+A socket is connected to one worker, so each row records which one (host:pid). When a
+worker dies its rows are removed by the prefork launcher, and a (re)started server
+removes the rows its host left behind. Rows hold the user id, not the username, so a
+rename shows up in the lists right away.
+"""
+import os
+import socket
+
+from ext import db
+from models import RoomPresence, User
+
+HOST = socket.gethostname()
+
+
+def worker_id(pid=None):
+    return f"{HOST}:{pid or os.getpid()}"
+
+
+def join(room, sid, user_id, is_connected):
+    """Record `sid` in `room`. The user's other tabs and devices stay listed; only rows of
+    this worker whose socket is gone (a disconnect that never ran) are dropped."""
+    for row in RoomPresence.query.filter_by(room=room, user_id=user_id, worker=worker_id()):
+        if row.sid != sid and not is_connected(row.sid): db.session.delete(row)
+    db.session.merge(RoomPresence(sid=sid, room=room, user_id=user_id, worker=worker_id()))
+    db.session.commit()
+
+
+def leave(sid, room=None):
+    """Remove `sid` from `room` (every room if None). Returns (room, username) for each room
+    the user is now gone from, i.e. where they have no other socket left."""
+    query = RoomPresence.query.filter_by(sid=sid)
+    if room is not None: query = query.filter_by(room=room)
+    rows = query.all()
+    if not rows: return []
+    user_id, rooms = rows[0].user_id, [p.room for p in rows]  # a socket is one user's
+    query.delete()
+    db.session.commit()
+    still_here = {r for (r,) in db.session.query(RoomPresence.room).filter(
+        RoomPresence.room.in_(rooms), RoomPresence.user_id == user_id)}
+    username = db.session.query(User.username).filter(User.id == user_id).scalar()
+    return [(r, username) for r in rooms if r not in still_here]
+
+
+def users(room):
+    """Usernames online in `room`, each once even with several tabs open."""
+    return [name for (name,) in db.session.query(User.username)
+            .join(RoomPresence, RoomPresence.user_id == User.id).filter(RoomPresence.room == room).distinct()]
+
+
+def clear_worker(pid):
+    RoomPresence.query.filter_by(worker=worker_id(pid)).delete()
+    db.session.commit()
+
+
+def clear_host():
+    RoomPresence.query.filter(RoomPresence.worker.startswith(f"{HOST}:", autoescape=True)).delete(synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,233 @@
+import io
+import os
+import math
+import sys
+import time
+import pstats
+import cProfile
+import itertools
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from flask import request, g
+from flask_login import current_user
+
+import async_mode
+from ext import app_extension
+
+ENGINES = ('cprofile', 'pyinstrument')
+
+# Innermost frames of a thread that is waiting, not working. Skipped by the sampler unless idle=True.
+IDLE_FILES = {'threading.py', 'selectors.py', 'socket.py', 'queue.py', 'ssl.py', 'selector_events.py', 'hub.py'}
+
+
+class _Run:
+    """One in-flight capture of a request or Socket.IO event."""
+
+    def __init__(self, engine, target):
+        self.engine, self.target = engine, target
+        self.started = datetime.utcnow()
+        self._t0 = time.perf_counter()
+        if engine == 'pyinstrument':
+            from pyinstrument import Profiler
+            self.prof = Profiler(async_mode='disabled')
+            self.prof.start()
+        else:
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+
+    def stop(self, capture_id):
+        ms = (time.perf_counter() - self._t0) * 1000
+        if self.engine == 'pyinstrument':
+            self.prof.stop()
+            body, mimetype = self.prof.output_html(), 'text/html'
+        else:
+            self.prof.disable()
+            out = io.StringIO()
+            pstats.Stats(self.prof, stream=out).sort_stats('cumulative').print_stats(60)
+            body, mimetype = out.getvalue(), 'text/plain'
+        return {'id': capture_id, 'target': self.target, 'engine': self.engine,
+                'started': self.started.isoformat(timespec='seconds'), 'ms': round(ms, 1),
+                'body': body, 'mimetype': mimetype}
+
+
+class StackSampler:
+    """Samples every thread's Python stack from a real OS thread and counts them as
+    collapsed stacks ("root;outer;inner count" lines, for flamegraph.pl or speedscope).
+
+    Runs only between start() and stop() / its time limit, so it costs nothing otherwise.
+    Under gevent the main thread's stack is whichever greenlet is running at that moment.
+    """
+
+    def __init__(self, max_seconds=600):
+        self.max_seconds = max_seconds
+        self.running = False
+        self.interval = 0.01
+        self.idle = False
+        self.samples = 0
+        self.started = None
+        self._stacks = Counter()
+        self._lock = async_mode.original('_thread', 'allocate_lock')()  # shared with a real OS thread
+        self._stop_at = 0.0
+        self._main_ident = None
+        self._generation = 0  # bumped by start() and stop(); a thread of an older one exits
+
+    def start(self, interval=0.01, seconds=60, idle=False):
+        """Sample every `interval` seconds for `seconds` (at most max_seconds). Returns
+        False if a run is already going; raises ValueError for non-finite or negative values."""
+        if not (math.isfinite(interval) and math.isfinite(seconds)) or interval < 0 or seconds <= 0:
+            raise ValueError("interval and seconds must be finite, positive numbers")
+        with self._lock:
+            if self.running: return False
+            self._generation += 1
+            generation = self._generation
+            self._stacks = Counter()
+            self.interval, self.idle, self.samples = min(max(interval, 0.001), 1.0), idle, 0
+            self.started = datetime.utcnow()
+            self._stop_at = time.monotonic() + min(seconds, self.max_seconds)
+            self.running = True
+        async_mode.original('_thread', 'start_new_thread')(self._run, (generation,))
+        return True
+
+    def stop(self):
+        with self._lock:
+            self._generation += 1
+            self.running = False
+
+    def _run(self, generation):
+        try:
+            self._sample(generation)
+        finally:
+            with self._lock:
+                if self._generation == generation: self.running = False
+
+    def _sample(self, generation):
+        sleep = async_mode.original('time', 'sleep')
+        me = async_mode.original('_thread', 'get_ident')()
+        while self._generation == generation and time.monotonic() < self._stop_at:
+            batch = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                if not self.idle and os.path.basename(frame.f_code.co_filename) in IDLE_FILES: continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                stack.append('main' if ident == self._main_ident else 'worker')
+                batch.append(';'.join(reversed(stack)))
+            with self._lock:
+                if self._generation != generation: return  # stopped (and maybe restarted) meanwhile
+                self._stacks.update(batch)
+                self.samples += 1
+            sleep(self.interval)
+
+    def collapsed(self):
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return ''.join(f"{stack} {n}\n" for stack, n in stacks)
+
+    def status(self):
+        return {'running': self.running, 'samples': self.samples, 'interval': self.interval,
+                'started': self.started.isoformat(timespec='seconds') if self.started else None}
+
+
+class Profiler:
+    """Opt-in profiling of chosen endpoints / Socket.IO events, plus the stack sampler.
+
+    An admin arms a target ('endpoint:map_search', 'event:send_message') for the next
+    N calls; each one is captured with cProfile or pyinstrument and kept in memory.
+    With PROFILING_ENABLED off no hook is installed at all.
+    """
+
+    def __init__(self, keep=20):
+        self.enabled = False
+        self.admins = frozenset()
+        self.captures = deque(maxlen=keep)
+        self.sampler = StackSampler()
+        self._armed = {}  # target -> [engine, calls left]
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._busy = threading.Lock()  # one capture at a time: profilers don't nest
+
+    def init_app(self, app, socketio):
+        self.enabled = app.config.get('PROFILING_ENABLED', False)
+        self.admins = frozenset(app.config.get('PROFILING_ADMINS', ()))
+        self.captures = deque(maxlen=app.config.get('PROFILING_KEEP', self.captures.maxlen))
+        self.sampler.max_seconds = app.config.get('PROFILING_SAMPLER_MAX_SECONDS', self.sampler.max_seconds)
+        app.extensions['profiler'] = self
+        if not self.enabled: return
+
+        self.sampler._main_ident = async_mode.original('_thread', 'get_ident')()
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+        # Flask-SocketIO has no per-event hook, but its dispatcher looks this up on every event
+        handle_event = socketio._handle_event
+
+        def _handle_event(handler, message, *args):
+            run = self._start(f"event:{message}")
+            if run is None: return handle_event(handler, message, *args)
+            try:
+                return handle_event(handler, message, *args)
+            finally:
+                self._finish(run)
+        socketio._handle_event = _handle_event
+
+    def is_admin(self):
+        return self.enabled and current_user.is_authenticated and current_user.id in self.admins
+
+    # --- Arming ---
+    def arm(self, target, engine='cprofile', count=1):
+        if engine not in ENGINES: raise ValueError(f"engine must be one of {', '.join(ENGINES)}")
+        if not target.startswith(('endpoint:', 'event:')): raise ValueError("target must be 'endpoint:<name>' or 'event:<name>'")
+        if engine == 'pyinstrument':
+            try:
+                import pyinstrument  # noqa: F401
+            except ImportError:
+                raise RuntimeError("pyinstrument is not installed (pip install pyinstrument)")
+        with self._lock:
+            self._armed[target] = [engine, max(1, count)]
+
+    def get(self, capture_id):
+        return next((c for c in self.captures if c['id'] == capture_id), None)
+
+    def status(self):
+        with self._lock:
+            armed = {t: {'engine': e, 'remaining': n} for t, (e, n) in self._armed.items()}
+        return {'armed': armed, 'sampler': self.sampler.status(),
+                'captures': [{k: v for k, v in c.items() if k != 'body'} for c in reversed(self.captures)]}
+
+    # --- Capturing ---
+    def _start(self, target):
+        if target not in self._armed: return None  # all it costs when nothing is armed
+        if not self._busy.acquire(blocking=False): return None
+        with self._lock:
+            shot = self._armed.get(target)
+            if shot:
+                shot[1] -= 1
+                if shot[1] <= 0: del self._armed[target]
+        if not shot:
+            self._busy.release()
+            return None
+        try:
+            return _Run(shot[0], target)
+        except Exception:  # e.g. another profiler already active in this thread: skip, don't fail the request
+            self._busy.release()
+            return None
+
+    def _finish(self, run):
+        try:
+            self.captures.append(run.stop(next(self._ids)))
+        finally:
+            self._busy.release()
+
+    def _before_request(self):
+        run = self._start(f"endpoint:{request.endpoint}")
+        if run: g._profile_run = run
+
+    def _teardown_request(self, exc):
+        run = g.pop('_profile_run', None)
+        if run: self._finish(run)
+
+
+profiler = app_extension('profiler')
@@ -0,0 +1,237 @@
+import time
+import threading
+from collections import Counter
+from functools import wraps
+from flask import request, jsonify, abort, make_response
+from flask_login import current_user
+
+from ext import app_extension
+
+# rule -> (tokens per second, burst). Overridden by app.config['RATE_LIMITS'].
+DEFAULT_RULES = {
+    'send_message': (5, 10),
+    'typing': (2, 4),
+    'join': (1, 5),
+    'load_older': (2, 5),
+    'create_location': (0.2, 5),
+    'favorite': (1, 10),
+    'room_write': (1, 10),
+}
+
+# Atomic token bucket in Redis (server clock, so every worker agrees on "now")
+REDIS_BUCKET = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = math.min(burst, (tonumber(b[1]) or burst) + (now - (tonumber(b[2]) or now)) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class LocalStore:
+    """Buckets in this process's memory. Per worker: N workers allow N times the rate."""
+
+    PRUNE_EVERY = 10000
+
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, monotonic time)
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def take(self, key, rate, burst):
+        """Take one token. Returns 0 if allowed, else seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0: self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # A bucket idle long enough to be full again is the same as no bucket
+        idle = [k for k, (_, last) in self._buckets.items() if now - last > 300]
+        for k in idle: del self._buckets[k]
+
+
+class RedisStore:
+    """Buckets shared by every worker through Redis (RATE_LIMIT_STORAGE_URL)."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_STORAGE_URL needs the redis package (pip install redis)")
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(REDIS_BUCKET)
+
+    def take(self, key, rate, burst):
+        return float(self._script(keys=[f"friendus:rl:{key}"], args=[rate, burst]))
+
+
+class RateLimiter:
+    """Token buckets keyed by (rule, user), for HTTP views and Socket.IO handlers."""
+
+    def __init__(self):
+        self.rules = dict(DEFAULT_RULES)
+        self.store = LocalStore()
+        self.enabled = True
+        self.counts = Counter()  # (rule, 'allowed' | 'throttled') -> n
+
+    def init_app(self, app):
+        self.rules.update(app.config.get('RATE_LIMITS', {}))
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', True)
+        url = app.config.get('RATE_LIMIT_STORAGE_URL')
+        self.store = RedisStore(url) if url else LocalStore()
+        app.extensions['rate_limiter'] = self
+
+    def _key(self):
+        return current_user.get_id() if current_user.is_authenticated else request.remote_addr
+
+    def hit(self, rule, key=None):
+        """Spend one token of `rule` for the current user. Returns seconds to wait (0 = allowed)."""
+        if not self.enabled: return 0.0
+        rate, burst = self.rules[rule]
+        wait = self.store.take(f"{rule}:{key or self._key()}", rate, burst)
+        self.counts[(rule, 'throttled' if wait else 'allowed')] += 1
+        return wait
+
+
+def limit(rule):
+    """View decorator: 429 with Retry-After when the user is over `rule` of the app's limiter."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            wait = limiter.hit(rule)
+            if wait:
+                retry_after = max(1, round(wait))
+                if request.is_json:
+                    response = make_response(jsonify({'error': 'Too many requests', 'retry_after': retry_after}), 429)
+                    response.headers['Retry-After'] = str(retry_after)
+                    return response
+                abort(429, retry_after=retry_after)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def limit_event(rule, notify=True):
+    """Socket.IO handler decorator: over the limit, the event is dropped and the
+    sender gets a 'throttled' event instead. With notify=False it is dropped silently,
+    for events a client sends on its own (typing) where an answer would only add traffic."""
+    from flask_socketio import emit
+
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            if current_user.is_authenticated:
+                wait = limiter.hit(rule)
+                if wait:
+                    if notify: emit('throttled', {'event': rule, 'retry_after': round(wait, 2)}, to=request.sid)
+                    return
+            return handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SendQueues:
+    """Backpressure for room fan-out.
+
+    Every connection has an Engine.IO send queue. When a slow client falls more than
+    `max_backlog` packets behind, 'drop' events (typing, joins/leaves) are skipped for it,
+    'coalesce' events (user lists) keep only the latest payload until it catches up, and
+    past `disconnect_backlog` the client is disconnected (it reloads history on reconnect).
+    """
+
+    FLUSH_INTERVAL = 0.25
+
+    def __init__(self, max_backlog=64, disconnect_backlog=1000):
+        self.max_backlog = max_backlog
+        self.disconnect_backlog = disconnect_backlog
+        self.socketio = None
+        self.counts = Counter()   # (event, 'dropped' | 'coalesced' | 'disconnected') -> n
+        self._pending = {}        # (sid, event) -> latest coalesced payload
+        self.typing = set()       # (sid, room) whose last forwarded typing_status was isTyping: True
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def init_app(self, app, socketio):
+        self.max_backlog = app.config.get('SOCKET_MAX_BACKLOG', self.max_backlog)
+        self.disconnect_backlog = app.config.get('SOCKET_DISCONNECT_BACKLOG', self.disconnect_backlog)
+        self.socketio = socketio
+        app.extensions['send_queues'] = self
+
+    def backlog(self, eio_sid):
+        sock = self.socketio.server.eio.sockets.get(eio_sid)
+        return sock.queue.qsize() if sock is not None else 0
+
+    def fanout(self, event, data, room, policy='deliver', skip_sid=None):
+        """Emit to a room, applying `policy` ('deliver', 'drop', 'coalesce') to backlogged clients."""
+        skip = [skip_sid] if skip_sid else []
+        for sid, eio_sid in self.socketio.server.manager.get_participants('/', room):
+            if sid == skip_sid: continue
+            depth = self.backlog(eio_sid)
+            if depth > self.disconnect_backlog:
+                self.counts[(event, 'disconnected')] += 1
+                self.socketio.server.disconnect(sid)
+                skip.append(sid)
+            elif depth > self.max_backlog and policy != 'deliver':
+                skip.append(sid)
+                self.counts[(event, 'dropped' if policy == 'drop' else 'coalesced')] += 1
+                if policy == 'coalesce': self._coalesce(sid, event, data)
+        # One encode for the whole room; only the backlogged sids are skipped
+        self.socketio.emit(event, data, to=room, skip_sid=skip or None)
+
+    def _coalesce(self, sid, event, data):
+        with self._lock:
+            self._pending[(sid, event)] = data
+            if self._flusher is None:
+                self._flusher = self.socketio.start_background_task(self._flush_loop)
+
+    def _flush_loop(self):
+        while True:
+            self.socketio.sleep(self.FLUSH_INTERVAL)
+            with self._lock:
+                items = list(self._pending.items())
+                if not items:
+                    self._flusher = None
+                    return
+            for (sid, event), data in items:
+                manager = self.socketio.server.manager
+                if not manager.is_connected(sid, '/'):
+                    pass  # gone; forget it
+                elif self.backlog(manager.eio_sid_from_sid(sid, '/')) > self.max_backlog:
+                    continue  # still behind; keep only the latest payload
+                else:
+                    self.socketio.emit(event, data, to=sid)
+                with self._lock:
+                    if self._pending.get((sid, event)) is data: del self._pending[(sid, event)]
+
+
+def metrics_text(limiter, queues, worker):
+    """Throttle and backpressure counters in Prometheus text format.
+
+    The counters belong to this process, and a scrape reaches whichever worker accepts
+    it, so every series carries a `worker` label; sum over it for the whole server.
+    """
+    lines = ['# TYPE friendus_rate_limit_total counter']
+    for (rule, outcome), n in sorted(limiter.counts.items()):
+        lines.append(f'friendus_rate_limit_total{{worker="{worker}",rule="{rule}",outcome="{outcome}"}} {n}')
+    lines.append('# TYPE friendus_socket_backpressure_total counter')
+    for (event, action), n in sorted(queues.counts.items()):
+        lines.append(f'friendus_socket_backpressure_total{{worker="{worker}",event="{event}",action="{action}"}} {n}')
+    with queues._lock:
+        pending = len(queues._pending)
+    lines += ['# TYPE friendus_socket_coalesced_pending gauge', f'friendus_socket_coalesced_pending{{worker="{worker}"}} {pending}']
+    return '\n'.join(lines) + '\n'
+
+
+limiter = app_extension('rate_limiter')
+send_queues = app_extension('send_queues')
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict, namedtuple
+from flask import abort
+from sqlalchemy import exists, insert
+
+from ext import db, app_extension
+from models import Room, User, room_members
+
+# What the chat routes and socket handlers need to know about a room.
+# `members` maps user id -> username.
+RoomInfo = namedtuple('RoomInfo', 'id name description creator_id members version')
+
+
+class RoomContext:
+    """Per-room metadata + member cache shared by the HTTP routes and Socket.IO handlers.
+
+    Every room has a version counter. Joins, leaves, deletes and member renames bump
+    it, which drops the cached entry so the next lookup reloads it, in this process
+    and, through the cache bus, in the other workers.
+    """
+
+    def __init__(self, max_rooms=512):
+        self.max_rooms = max_rooms
+        self._versions = {}          # room_id -> int
+        self._rooms = OrderedDict()  # room_id -> RoomInfo
+        self._names = {}             # room name -> room_id
+        self._generation = 0         # bumped by clear(), which drops every room at once
+        self._lock = threading.Lock()
+        self.bus = None
+
+    def init_app(self, app):
+        self.max_rooms = app.config.get('ROOM_CACHE_SIZE', self.max_rooms)
+        app.extensions['room_context'] = self
+        self.bus = app.extensions['cache_bus']
+        self.bus.subscribe('room', self._drop, self.clear)
+
+    # --- Lookups ---
+    def get(self, room_id):
+        with self._lock:
+            info = self._rooms.get(room_id)
+            if info:
+                self._rooms.move_to_end(room_id)
+                return info
+        room = db.session.get(Room, room_id)
+        return self._load(room) if room else None
+
+    def get_by_name(self, name):
+        with self._lock:
+            room_id = self._names.get(name)
+        if room_id is not None: return self.get(room_id)
+        room = Room.query.filter_by(name=name).first()
+        return self._load(room) if room else None
+
+    def get_or_404(self, room_id):
+        return self.get(room_id) or abort(404)
+
+    def get_by_name_or_404(self, name):
+        return self.get_by_name(name) or abort(404)
+
+    def is_member(self, room_id, user_id):
+        with self._lock:
+            info = self._rooms.get(room_id)
+        if info: return user_id in info.members
+        # Not cached: hits the (user_id, room_id) primary key instead of loading the member list
+        return db.session.query(exists().where(
+            room_members.c.room_id == room_id, room_members.c.user_id == user_id
+        )).scalar()
+
+    def version(self, room_id):
+        with self._lock:
+            return self._versions.get(room_id, 0)
+
+    # --- Writes ---
+    def add_member(self, room_id, user_id):
+        """Add a user to a room. Returns False if they were already a member."""
+        if self.is_member(room_id, user_id): return False
+        db.session.execute(insert(room_members).values(room_id=room_id, user_id=user_id))
+        db.session.commit()
+        self.bump(room_id)
+        return True
+
+    def remove_member(self, room_id, user_id):
+        db.session.execute(room_members.delete().where(
+            room_members.c.room_id == room_id, room_members.c.user_id == user_id
+        ))
+        db.session.commit()
+        self.bump(room_id)
+
+    def bump(self, room_id):
+        """Call after anything that changes a room's members or metadata (join, leave, delete)."""
+        self._drop(room_id)
+        self.bus.publish('room', room_id)
+
+    def _drop(self, room_id):
+        with self._lock:
+            self._versions[room_id] = self._versions.get(room_id, 0) + 1
+            info = self._rooms.pop(room_id, None)
+            if info and self._names.get(info.name) == room_id:
+                del self._names[info.name]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._rooms.clear()
+            self._names.clear()
+
+    def bump_user_rooms(self, user_id):
+        """A member's username changed: every room they are in has a stale member map."""
+        room_ids = db.session.query(room_members.c.room_id).filter(room_members.c.user_id == user_id).all()
+        for (room_id,) in room_ids:
+            self.bump(room_id)
+
+    def _load(self, room):
+        with self._lock:
+            version, generation = self._versions.get(room.id, 0), self._generation
+        members = dict(
+            db.session.query(User.id, User.username)
+            .join(room_members, room_members.c.user_id == User.id)
+            .filter(room_members.c.room_id == room.id)
+            .all()
+        )
+        info = RoomInfo(room.id, room.name, room.description, room.creator_id, members, version)
+        with self._lock:
+            # Skip caching if a join/leave raced with the load; the next lookup retries
+            if self._versions.get(room.id, 0) == version and self._generation == generation:
+                self._rooms[room.id] = info
+                self._names[room.name] = room.id
+                while len(self._rooms) > self.max_rooms:
+                    old = self._rooms.popitem(last=False)[1]
+                    if self._names.get(old.name) == old.id: del self._names[old.name]
+        return info
+
+
+room_context = app_extension('room_context')
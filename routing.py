@@ -0,0 +1,276 @@
+import os
+import glob
+import json
+import time
+import shutil
+import threading
+import click
+import numpy as np
+from flask import current_app, g
+
+# Street graph on disk: one .npy per array so StreetGraph can np.load(mmap_mode='r') them.
+# Nodes are 0..N-1; edges are in CSR form (edges of node i are indptr[i]:indptr[i+1]).
+GRAPH_ARRAYS = ('osmid', 'lat', 'lon', 'indptr', 'indices', 'travel_time', 'length')
+METERS_PER_DEGREE = 111320.0  # of latitude; snapping distances are measured in that flat space
+
+
+# --- Building ---
+def build_graph(cache_folder, place=None, bbox=None, point=None, dist=2000, network_type='drive', from_cache=False):
+    """Download (or read from the osmnx cache) a street graph and add per-edge travel times."""
+    import osmnx as ox
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = cache_folder
+
+    if from_cache:
+        # Build from the Overpass responses already in cache/, no network needed. That folder
+        # also holds `import-osm` POI responses, so only highway ways go into the graph.
+        path = _cached_streets_xml(cache_folder, network_type)
+        try:
+            G = ox.graph_from_xml(path, bidirectional=network_type in ox.settings.bidirectional_network_types)
+        finally:
+            os.remove(path)
+    elif place:
+        G = ox.graph_from_place(place, network_type=network_type)
+    elif bbox:
+        G = ox.graph_from_bbox(bbox, network_type=network_type)
+    else:
+        G = ox.graph_from_point(point, dist=dist, network_type=network_type)
+
+    G = ox.routing.add_edge_speeds(G)
+    return ox.routing.add_edge_travel_times(G)
+
+
+def _cached_streets_xml(cache_folder, network_type):
+    """Write the street ways (and their nodes) of every cached Overpass response to a
+    temporary OSM XML file for ox.graph_from_xml. Returns its path."""
+    import tempfile
+    import xml.etree.ElementTree as ET
+
+    nodes, ways = {}, {}
+    for path in glob.glob(os.path.join(cache_folder, '*.json')):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict): continue
+        for el in data.get('elements', ()):
+            if el.get('type') == 'node' and 'lat' in el:
+                nodes[el['id']] = el
+            elif el.get('type') == 'way' and _is_street(el.get('tags', {}), network_type):
+                ways[el['id']] = el
+    if not ways: raise click.ClickException(f"No cached street network responses in {cache_folder}")
+
+    root = ET.Element('osm', version='0.6')
+    used = {n for way in ways.values() for n in way['nodes']}
+    for osmid in used & nodes.keys():
+        ET.SubElement(root, 'node', id=str(osmid), lat=str(nodes[osmid]['lat']), lon=str(nodes[osmid]['lon']))
+    for way in ways.values():
+        el = ET.SubElement(root, 'way', id=str(way['id']))
+        for n in way['nodes']:
+            if n in nodes: ET.SubElement(el, 'nd', ref=str(n))
+        for k, v in way.get('tags', {}).items():
+            ET.SubElement(el, 'tag', k=k, v=str(v))
+    fd, path = tempfile.mkstemp(suffix='.osm')
+    with os.fdopen(fd, 'wb') as f:
+        ET.ElementTree(root).write(f, encoding='utf-8', xml_declaration=True)
+    return path
+
+
+# highway values that are never part of a drivable street network
+NOT_DRIVABLE = {'footway', 'path', 'pedestrian', 'steps', 'cycleway', 'bridleway', 'track', 'corridor',
+                'elevator', 'escalator', 'platform', 'bus_guideway', 'raceway', 'construction',
+                'proposed', 'planned', 'abandoned', 'razed', 'no'}
+
+
+def _is_street(tags, network_type):
+    highway = tags.get('highway')
+    if not highway or tags.get('area') == 'yes': return False
+    if network_type == 'drive':
+        return highway not in NOT_DRIVABLE and tags.get('access') != 'private' and tags.get('motor_vehicle') != 'no'
+    return True
+
+
+def save_graph(G, folder):
+    """Flatten a networkx MultiDiGraph into CSR arrays (parallel edges keep the fastest one)."""
+    osmids = np.fromiter(G.nodes, dtype=np.int64)
+    index = {osmid: i for i, osmid in enumerate(osmids)}
+    lat = np.array([G.nodes[n]['y'] for n in osmids], dtype=np.float64)
+    lon = np.array([G.nodes[n]['x'] for n in osmids], dtype=np.float64)
+
+    best = {}
+    for u, v, data in G.edges(data=True):
+        key = (index[u], index[v])
+        edge = (float(data.get('travel_time', 0.0)), float(data.get('length', 0.0)))
+        if key not in best or edge[0] < best[key][0]: best[key] = edge
+
+    keys = sorted(best)
+    src = np.array([k[0] for k in keys], dtype=np.int32)
+    arrays = {
+        'osmid': osmids, 'lat': lat, 'lon': lon,
+        'indptr': np.concatenate(([0], np.cumsum(np.bincount(src, minlength=len(osmids))))).astype(np.int32),
+        'indices': np.array([k[1] for k in keys], dtype=np.int32),
+        'travel_time': np.array([best[k][0] for k in keys], dtype=np.float64),  # what dijkstra works in: no per-call copy
+        'length': np.array([best[k][1] for k in keys], dtype=np.float32),
+    }
+    # Never rewrite the arrays in place: running workers have them mmapped, and truncating
+    # a mapped file kills them with SIGBUS. Each build goes into its own subfolder, and
+    # CURRENT is switched to it atomically once every array is written.
+    version = str(time.time_ns())  # sorts in build order
+    build = os.path.join(folder, version)
+    os.makedirs(build)
+    for name in GRAPH_ARRAYS:
+        np.save(os.path.join(build, f'{name}.npy'), arrays[name])
+    pointer = os.path.join(folder, 'CURRENT')
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(pointer + '.tmp', pointer)
+
+    # Keep the previous build for a loader that read CURRENT just before the switch. Older
+    # ones, and arrays of the pre-versioned layout, are unlinked: mapped readers keep theirs.
+    builds = sorted(d for d in os.listdir(folder) if d != version and os.path.isdir(os.path.join(folder, d)))
+    for old in builds[:-1]:
+        shutil.rmtree(os.path.join(folder, old), ignore_errors=True)
+    for name in GRAPH_ARRAYS:
+        if os.path.exists(os.path.join(folder, f'{name}.npy')): os.remove(os.path.join(folder, f'{name}.npy'))
+    return len(osmids), len(keys)
+
+
+def graph_build(folder):
+    """Subfolder with the arrays of the graph build in use, or None before the first build."""
+    try:
+        with open(os.path.join(folder, 'CURRENT')) as f:
+            return os.path.join(folder, f.read().strip())
+    except FileNotFoundError:
+        # Saved before builds were versioned: arrays directly in the folder
+        return folder if os.path.exists(os.path.join(folder, 'indptr.npy')) else None
+
+
+# --- Querying ---
+class StreetGraph:
+    """Memory-mapped street graph: snapping, shortest paths and travel-time matrices."""
+
+    def __init__(self, build):
+        from scipy.sparse import csr_matrix
+        from scipy.spatial import cKDTree
+
+        arrays = {name: np.load(os.path.join(build, f'{name}.npy'), mmap_mode='r') for name in GRAPH_ARRAYS}
+        self.osmid, self.lat, self.lon = arrays['osmid'], arrays['lat'], arrays['lon']
+        self.indptr, self.indices, self.length = arrays['indptr'], arrays['indices'], arrays['length']
+        n = len(self.osmid)
+        travel_time = arrays['travel_time']
+        if travel_time.dtype != np.float64: travel_time = travel_time.astype(np.float64)  # graph saved before float64
+        self.matrix = csr_matrix((travel_time, arrays['indices'], arrays['indptr']), shape=(n, n))
+
+        # Snap in a locally-flat x/y space (degrees of longitude shrink with latitude)
+        self._cos_lat = np.cos(np.radians(float(np.mean(self.lat)))) if n else 1.0
+        self._tree = cKDTree(np.column_stack((self.lon * self._cos_lat, self.lat)))
+
+    def nearest_nodes(self, lats, lons, max_meters=None):
+        """Closest graph node per point; -1 where that node is more than `max_meters` away
+        (the point is outside the area the graph covers)."""
+        dist, idx = self._tree.query(np.column_stack((np.asarray(lons) * self._cos_lat, np.asarray(lats))))
+        idx = np.atleast_1d(idx)
+        if max_meters is not None:
+            idx = np.where(np.atleast_1d(dist) * METERS_PER_DEGREE > max_meters, -1, idx)
+        return idx
+
+    def from_sources(self, sources):
+        """Dijkstra from each source node: (seconds[len(sources), N], predecessors[len(sources), N])."""
+        from scipy.sparse.csgraph import dijkstra
+        return dijkstra(self.matrix, directed=True, indices=sources, return_predecessors=True)
+
+    def edge_length(self, u, v):
+        start, end = self.indptr[u], self.indptr[u + 1]
+        hit = np.nonzero(self.indices[start:end] == v)[0]
+        return float(self.length[start + hit[0]]) if len(hit) else 0.0
+
+    def path_info(self, predecessors, src, dst):
+        """Walk the predecessor row back from dst. Returns (node path, meters) or (None, None)."""
+        if src == dst: return [src], 0.0
+        path = [dst]
+        while path[-1] != src:
+            prev = predecessors[path[-1]]
+            if prev < 0: return None, None
+            path.append(prev)
+        path.reverse()
+        meters = sum(self.edge_length(u, v) for u, v in zip(path, path[1:]))
+        return path, meters
+
+    def coords(self, path):
+        return [[float(self.lat[i]), float(self.lon[i])] for i in path]
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    """The app's StreetGraph, loaded once per process. None if `flask build-graph` hasn't been run."""
+    global _graph
+    folder = current_app.config['ROUTING_GRAPH_DIR']
+    if _graph is None or _graph[0] != folder:
+        with _graph_lock:
+            if _graph is None or _graph[0] != folder:
+                build = graph_build(folder)
+                if build is None: return None
+                _graph = (folder, StreetGraph(build))
+    return _graph[1]
+
+
+def _legs():
+    # Per-request memo: (src_node, dst_node) -> (seconds, meters, node path)
+    if '_route_legs' not in g: g._route_legs = {}
+    return g._route_legs
+
+
+def route_legs(graph, nodes):
+    """Travel legs between every pair of `nodes`, each pair computed once per request."""
+    memo = _legs()
+    sources = [n for n in dict.fromkeys(nodes) if any((n, d) not in memo for d in nodes)]
+    if sources:
+        seconds, predecessors = graph.from_sources(sources)
+        for row, src in enumerate(sources):
+            for dst in nodes:
+                if (src, dst) in memo: continue
+                t = seconds[row, dst]
+                if np.isinf(t):
+                    memo[(src, dst)] = (None, None, None)
+                else:
+                    path, meters = graph.path_info(predecessors[row], src, dst)
+                    memo[(src, dst)] = (float(t), meters, path)
+    return memo
+
+
+def travel_matrix(graph, nodes):
+    """All-pairs travel time (seconds, None when unreachable) between the given graph nodes."""
+    memo = route_legs(graph, nodes)
+    return [[memo[(s, d)][0] for d in nodes] for s in nodes]
+
+
+# --- CLI: flask --app app build-graph --point 21.005,105.845 --dist 3000 ---
+@click.command('build-graph')
+@click.option('--place', help='Place name, e.g. "Hai Ba Trung, Hanoi"')
+@click.option('--bbox', help='west,south,east,north in degrees')
+@click.option('--point', help='lat,lon center; used with --dist')
+@click.option('--dist', type=float, default=2000, show_default=True, help='Meters around --point')
+@click.option('--network', default='drive', show_default=True, help='osmnx network_type (drive, walk, bike, all)')
+@click.option('--from-cache', is_flag=True, help='Build only from Overpass responses already in cache/')
+def build_graph_command(place, bbox, point, dist, network, from_cache):
+    """Build the routing graph once and store it as memory-mappable arrays."""
+    if sum(map(bool, (place, bbox, point, from_cache))) != 1:
+        raise click.UsageError('Give exactly one of --place, --bbox, --point or --from-cache')
+    try:
+        if bbox: bbox = tuple(float(v) for v in bbox.split(','))
+        if point: point = tuple(float(v) for v in point.split(','))
+    except ValueError:
+        raise click.BadParameter('coordinates must be comma-separated numbers')
+
+    cache_folder = os.path.join(current_app.root_path, 'cache')
+    G = build_graph(cache_folder, place=place, bbox=bbox, point=point, dist=dist,
+                    network_type=network, from_cache=from_cache)
+    folder = current_app.config['ROUTING_GRAPH_DIR']
+    nodes, edges = save_graph(G, folder)
+    click.echo(f"Saved {nodes} nodes, {edges} edges to {folder}")
+
+
+def init_app(app):
+    app.config.setdefault('ROUTING_GRAPH_DIR', os.path.join(app.root_path, 'graph'))
+    app.cli.add_command(build_graph_command)
@@ -1,5 +1,8 @@
 import sqlite3
-from app import app, db
+from app import create_app
+from ext import db
+
+app = create_app()
 
 # 1. Create new tables (Activity, Constraint, Outsider)
 print("--- Checking/Creating missing tables... ---")
@@ -9,7 +12,9 @@ with app.app_context():
 
 # 2. Manually add missing columns to existing tables
 print("\n--- Updating existing tables... ---")
-conn = sqlite3.connect('friendus.db')
+with app.app_context():
+    db_path = db.engine.url.database  # FRIENDUS_SQLALCHEMY_DATABASE_URI may point elsewhere
+conn = sqlite3.connect(db_path)
 cursor = conn.cursor()
 
 # List of updates needed for the merged features
@@ -33,6 +38,25 @@ for table, col, definition in updates:
         else:
             print(f" -> Note: {e}")
 
+# 3. Indexes that create_all() won't add to tables that already exist
+indexes = [
+    # Index Name,                Table,      Columns
+    ('ix_message_room',          'message',  'room'),
+    ('ix_outsider_creator_name', 'outsider', 'creator_id, name'),
+]
+
+for name, table, cols in indexes:
+    print(f"Ensuring index '{name}' on {table}({cols})...")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})")
+
+# 4. room_presence only holds live sockets: rebuild it if it predates user_id
+columns = [row[1] for row in cursor.execute("PRAGMA table_info(room_presence)")]
+if columns and 'user_id' not in columns:
+    print("Rebuilding 'room_presence' with user_id...")
+    cursor.execute("DROP TABLE room_presence")
+
 conn.commit()
 conn.close()
+with app.app_context():
+    db.create_all()
 print("\nDatabase update complete! You can now run app.py.")
\ No newline at end of file
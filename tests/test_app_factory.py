@@ -0,0 +1,111 @@
+"""Apps built by create_app() in one process keep their own extension state."""
+import os
+import time
+import tempfile
+import threading
+
+import pytest
+
+import prefork
+from app import create_app
+from ext import db
+from models import Room
+from rate_limit import DEFAULT_RULES
+from room_context import room_context
+
+EXTENSIONS = ('socketio', 'cache_bus', 'send_queues', 'profiler', 'user_cache', 'room_context',
+              'favorites', 'tile_index', 'http_cache', 'rate_limiter')
+
+
+def make_app(tmp_path, db_name, **config):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / db_name}.db",
+                      'WTF_CSRF_ENABLED': False, **config})
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def add_room(app, name):
+    with app.app_context():
+        room = Room(name=name)
+        db.session.add(room)
+        db.session.commit()
+        return room.id
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+def test_each_app_gets_its_own_extensions(tmp_path):
+    a = make_app(tmp_path, 'a', ROOM_CACHE_SIZE=8, RATE_LIMITS={'join': (1, 1)})
+    b = make_app(tmp_path, 'b', ROOM_CACHE_SIZE=16)
+
+    for name in EXTENSIONS:
+        assert a.extensions[name] is not b.extensions[name], name
+    assert a.extensions['room_context'].max_rooms == 8
+    assert b.extensions['room_context'].max_rooms == 16
+    assert a.extensions['rate_limiter'].rules['join'] == (1, 1)
+    assert b.extensions['rate_limiter'].rules['join'] == DEFAULT_RULES['join']
+    # Socket handlers are registered on both servers, not just the last one built
+    for app in (a, b):
+        assert 'join' in app.extensions['socketio'].server.handlers['/']
+
+
+def test_caches_keyed_by_id_read_their_own_database(tmp_path):
+    a = make_app(tmp_path, 'a')
+    b = make_app(tmp_path, 'b')
+    assert add_room(a, 'alpha') == add_room(b, 'beta') == 1
+
+    with a.app_context():
+        assert room_context.get(1).name == 'alpha'
+    with b.app_context():
+        assert room_context.get(1).name == 'beta'
+    with a.app_context():
+        assert room_context.get_by_name('beta') is None
+
+
+@pytest.fixture
+def relay():
+    relay = prefork.Relay(os.path.join(tempfile.mkdtemp(prefix='friendus-'), 'socketio.sock'))
+    threading.Thread(target=relay.serve_forever, daemon=True).start()
+    # Not closed: the apps' cache bus threads have no stop and use it until the process exits
+    return relay
+
+
+def make_workers(tmp_path, relay, count=2):
+    # Apps on one database and one relay, like prefork workers
+    apps = [make_app(tmp_path, 'shared', SOCKETIO_MESSAGE_QUEUE=prefork.LOCAL_SCHEME + relay.path) for _ in range(count)]
+    for app in apps:
+        app.extensions['cache_bus'].start()
+    wait_for(lambda: all(app.extensions['cache_bus'].in_sync for app in apps))
+    return apps
+
+
+def test_cache_bus_invalidates_the_other_app(tmp_path, relay):
+    a, b = make_workers(tmp_path, relay)
+    room_id = add_room(a, 'alpha')
+
+    with b.app_context():
+        assert room_context.get(room_id).description is None
+    with a.app_context():
+        db.session.get(Room, room_id).description = 'renamed'
+        db.session.commit()
+        room_context.bump(room_id)
+    wait_for(lambda: room_id not in b.extensions['room_context']._rooms)
+    with b.app_context():
+        assert room_context.get(room_id).description == 'renamed'
+
+
+def test_cache_bus_resets_after_a_missed_hello(tmp_path, relay):
+    a, = make_workers(tmp_path, relay, count=1)
+    room_id = add_room(a, 'alpha')
+    with a.app_context():
+        room_context.get(room_id)
+    assert room_id in a.extensions['room_context']._rooms
+
+    a.extensions['cache_bus']._sent += 1  # as if a hello was lost while unsubscribed
+    wait_for(lambda: room_id not in a.extensions['room_context']._rooms)
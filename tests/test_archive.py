@@ -0,0 +1,68 @@
+"""Chat history paging across the hot Message table and archived segments."""
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+from ext import db
+from models import Message, MessageArchive, User
+from test_app_factory import make_app
+
+
+@pytest.fixture
+def app(tmp_path):
+    """Room 'general' with messages 1..23, the first 17 old enough to archive, plus a message
+    in another room in between; archived into segments of 5."""
+    app = make_app(tmp_path, 'archive')
+    old = datetime.utcnow() - timedelta(days=200)
+    with app.app_context():
+        user = User(username='ann', email='ann@example.com', password='123')
+        db.session.add(user)
+        db.session.flush()
+        for i in range(1, 24):
+            db.session.add(Message(body=f'm{i}', room='general', user_id=user.id,
+                                   timestamp=old + timedelta(minutes=i) if i <= 17 else datetime.utcnow()))
+            if i == 10: db.session.add(Message(body='elsewhere', room='other', user_id=user.id, timestamp=old))
+        db.session.commit()
+        assert archive.archive_messages(datetime.utcnow() - timedelta(days=90), segment_size=5) == 18
+    return app
+
+
+def bodies(page):
+    return [m['msg'] for m in page]
+
+
+def test_old_messages_move_to_segments(app):
+    # Message id 11 is the other room's, so m11..m17 are ids 12..18; m18 (id 19) on stays hot
+    with app.app_context():
+        assert [m.body for m in Message.query.filter_by(room='general').order_by(Message.id)] == \
+            [f'm{i}' for i in range(18, 24)]
+        assert [(s.first_id, s.last_id, s.count) for s in MessageArchive.query.filter_by(room='general')
+                .order_by(MessageArchive.first_id)] == [(1, 5, 5), (6, 10, 5), (12, 16, 5), (17, 18, 2)]
+
+
+def test_pages_run_back_through_the_archive_in_order(app):
+    with app.app_context():
+        pages, before = [], None
+        while True:
+            page = archive.room_history('general', before, limit=4)
+            if not page: break
+            assert [m['id'] for m in page] == sorted(m['id'] for m in page)  # oldest first
+            assert {m['username'] for m in page} == {'ann'}
+            pages.append(bodies(page))
+            before = page[0]['id']
+    assert pages == [['m20', 'm21', 'm22', 'm23'], ['m16', 'm17', 'm18', 'm19'],
+                     ['m12', 'm13', 'm14', 'm15'], ['m8', 'm9', 'm10', 'm11'],
+                     ['m4', 'm5', 'm6', 'm7'], ['m1', 'm2', 'm3']]
+
+
+def test_a_page_mixes_hot_and_archived_rows(app):
+    with app.app_context():
+        assert bodies(archive.room_history('general', limit=8)) == [f'm{i}' for i in range(16, 24)]
+
+
+def test_archived_rows_for_exports(app):
+    with app.app_context():
+        rows = list(archive.archived_rows('general'))
+    assert [body for _, _, _, body in rows] == [f'm{i}' for i in range(1, 18)]
+    assert {username for _, _, username, _ in rows} == {'ann'}
@@ -0,0 +1,114 @@
+"""Expense splitting: the cent arithmetic and the validation behind /api/room/<id>/split."""
+import pytest
+
+import finance
+from ext import db
+from models import Room, Transaction, User
+from test_app_factory import make_app
+
+
+@pytest.mark.parametrize('total, mode, participants, expected', [
+    (100, 'equal', [{}, {}, {}], [33.34, 33.33, 33.33]),
+    (0.05, 'equal', [{}, {}, {}], [0.02, 0.02, 0.01]),
+    (10, 'shares', [{'shares': 1}, {'shares': 2}], [3.33, 6.67]),
+    (1, 'shares', [{'shares': 1}, {'shares': 0}, {'shares': 2}], [0.33, 0, 0.67]),
+    (50.5, 'exact', [{'amount': 20.25}, {'amount': 30.25}], [20.25, 30.25]),
+])
+def test_split_amounts_are_whole_cents_summing_to_the_total(total, mode, participants, expected):
+    parts = finance.split_amounts(total, mode, participants)
+    assert parts == expected
+    assert round(sum(parts) * 100) == round(total * 100)
+
+
+def test_leftover_cents_go_to_the_largest_remainders():
+    # 1.00 by 1:1:1:3 -> 16.67, 16.67, 16.67, 50 cents: 16+16+16+50 leaves two cents, for
+    # the first two of the tied 2/3 remainders; the exact 50 gets none
+    parts = finance.split_amounts(1, 'shares', [{'shares': 1}, {'shares': 1}, {'shares': 1}, {'shares': 3}])
+    assert parts == [0.17, 0.17, 0.16, 0.5]
+
+
+@pytest.mark.parametrize('total, mode, participants, message', [
+    (100, 'exact', [{'amount': 60}, {'amount': 30}], 'add up to the total'),
+    (100, 'exact', [{'amount': 120}, {'amount': -20}], 'negative'),
+    (100, 'shares', [{'shares': 0}, {'shares': 0}], 'not all zero'),
+    (100, 'shares', [{'shares': '2'}], 'shares must be a number'),
+    (100, 'thirds', [{}], 'mode must be one of'),
+    (100, 'equal', [], 'at least one participant'),
+    (0, 'equal', [{}], 'total must be positive'),
+    (finance.MAX_AMOUNT + 1, 'equal', [{}], 'total must be a number'),
+    (float('nan'), 'equal', [{}], 'total must be a number'),
+    (float('inf'), 'equal', [{}], 'total must be a number'),
+    (True, 'equal', [{}], 'total must be a number'),
+    ('100', 'equal', [{}], 'total must be a number'),
+])
+def test_split_amounts_rejects(total, mode, participants, message):
+    with pytest.raises(ValueError, match=message):
+        finance.split_amounts(total, mode, participants)
+
+
+def test_split_amounts_accepts_max_amount():
+    assert finance.split_amounts(finance.MAX_AMOUNT, 'equal', [{}, {}]) == [finance.MAX_AMOUNT / 2] * 2
+
+
+@pytest.fixture
+def room_app(tmp_path):
+    """An app with a room of three members; the client is logged in as the first one."""
+    app = make_app(tmp_path, 'finance', RATE_LIMIT_ENABLED=False, SPLIT_MAX_PARTICIPANTS=3)
+    with app.app_context():
+        users = [User(username=f'user{i}', email=f'user{i}@example.com', password='123') for i in range(4)]
+        room = Room(name='trip', creator=users[0])
+        db.session.add_all(users + [room])
+        room.members.extend(users[:3])
+        db.session.commit()
+        ids = [u.id for u in users]
+        room_id = room.id
+    client = app.test_client()
+    client.post('/login', data={'email': 'user0@example.com', 'password': '123'})
+    return app, client, room_id, ids
+
+
+def transactions(app):
+    with app.app_context():
+        return [(t.sender_id, t.receiver_id, t.amount) for t in Transaction.query.order_by(Transaction.id)]
+
+
+def test_split_route_records_each_part_but_the_payers(room_app):
+    app, client, room_id, (me, a, b, _) = room_app
+    response = client.post(f'/api/room/{room_id}/split', json={
+        'total': 100, 'description': 'Dinner', 'mode': 'equal',
+        'participants': [{'user_id': me}, {'user_id': a}, {'user_id': b}]})
+    assert response.status_code == 201
+    assert [t['amount'] for t in response.get_json()['transactions']] == [33.33, 33.33]
+    assert transactions(app) == [(me, a, 33.33), (me, b, 33.33)]
+
+
+@pytest.mark.parametrize('body, message', [
+    ([1, 2], 'expected a JSON object'),
+    ({'total': 10, 'description': 'x', 'participants': 'everyone'}, 'participants must be a list of objects'),
+    ({'total': 10, 'description': 'x', 'participants': [1, 2]}, 'participants must be a list of objects'),
+    ({'total': 10, 'description': 'x', 'participants': [{}] * 4}, 'At most 3 participants'),
+    ({'total': 10, 'description': ' ', 'participants': [{'outsider': 'Minh'}]}, 'description is required'),
+    ({'total': 10, 'description': 'x', 'mode': 'exact', 'participants': [{'outsider': 'Minh', 'amount': 9}]},
+     'add up to the total'),
+    ({'total': 'lots', 'description': 'x', 'participants': [{'outsider': 'Minh'}]}, 'total must be a number'),
+    ({'total': 10, 'description': 'x', 'participants': [{'outsider': 'Minh'}, {'outsider': 'Minh'}]},
+     'participants must be unique'),
+    ({'total': 10, 'description': 'x', 'participants': [{'user_id': '2'}]}, 'user_id must be an integer id'),
+    ({'total': 10, 'description': 'x', 'payer_id': True, 'participants': [{'outsider': 'Minh'}]},
+     'payer_id must be an integer id'),
+])
+def test_split_route_answers_400(room_app, body, message):
+    app, client, room_id, _ = room_app
+    response = client.post(f'/api/room/{room_id}/split', json=body)
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
+    assert transactions(app) == []
+
+
+def test_split_route_rejects_non_members(room_app):
+    app, client, room_id, (_, _, _, outside) = room_app
+    response = client.post(f'/api/room/{room_id}/split', json={
+        'total': 10, 'description': 'x', 'participants': [{'user_id': outside}]})
+    assert response.status_code == 400
+    assert 'not a member' in response.get_json()['error']
+    assert transactions(app) == []
@@ -0,0 +1,45 @@
+"""Token buckets of the per-process LocalStore."""
+import pytest
+
+import rate_limit
+from rate_limit import LocalStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_burst_then_wait_for_the_next_token(clock):
+    store = LocalStore()
+    assert [store.take('typing:1', 2, 4) for _ in range(4)] == [0, 0, 0, 0]
+    assert store.take('typing:1', 2, 4) == pytest.approx(0.5)
+    clock[0] += 0.25
+    assert store.take('typing:1', 2, 4) == pytest.approx(0.25)  # a refused take spends nothing
+    clock[0] += 0.25
+    assert store.take('typing:1', 2, 4) == 0
+
+
+def test_buckets_refill_up_to_the_burst_only(clock):
+    store = LocalStore()
+    for _ in range(3): store.take('join:1', 1, 3)
+    clock[0] += 60
+    assert [store.take('join:1', 1, 3) for _ in range(4)] == [0, 0, 0, pytest.approx(1)]
+
+
+def test_keys_have_their_own_buckets(clock):
+    store = LocalStore()
+    assert store.take('join:1', 1, 1) == 0
+    assert store.take('join:1', 1, 1) > 0
+    assert store.take('join:2', 1, 1) == 0
+
+
+def test_idle_buckets_are_pruned(clock, monkeypatch):
+    monkeypatch.setattr(LocalStore, 'PRUNE_EVERY', 2)
+    store = LocalStore()
+    store.take('join:1', 1, 1)
+    clock[0] += 301
+    store.take('join:2', 1, 1)
+    assert list(store._buckets) == ['join:2']
@@ -0,0 +1,78 @@
+"""TileIndex: clusters per tile cell, ratings, moved locations and point tiles."""
+import json
+
+import pytest
+
+from ext import db
+from http_cache import http_cache
+from models import Location, Review, User
+from tiles import tile_xy
+from test_app_factory import make_app
+
+HANOI = [(21.0285, 105.8542), (21.0290, 105.8550)]
+PARIS = (48.8566, 2.3522)
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path, 'tiles', TILE_CLUSTER_MAX_ZOOM=4, TILE_REFRESH_SECONDS=0)
+    with app.app_context():
+        db.session.add_all(Location(name=f'place{i}', description='', latitude=lat, longitude=lon)
+                           for i, (lat, lon) in enumerate(HANOI + [PARIS]))
+        db.session.commit()
+    return app
+
+
+def tile(app, z, lat, lon):
+    index = app.extensions['tile_index']
+    x, y = (int(v) for v in tile_xy(lat, lon, z))
+    with app.test_request_context():
+        index.refresh()
+        return json.loads(index.render(z, x, y)), index.etag(z, x, y)
+
+
+def counts(body):
+    return sorted(c['count'] for c in body['clusters'])
+
+
+def test_nearby_locations_share_a_cell(app):
+    world, _ = tile(app, 0, *PARIS)
+    assert counts(world) == [1, 2]
+    hanoi, _ = tile(app, 4, *HANOI[0])
+    assert counts(hanoi) == [2]
+    cluster = hanoi['clusters'][0]
+    assert cluster['lat'] == pytest.approx(sum(p[0] for p in HANOI) / 2)
+    assert cluster['rating'] == 0
+
+
+def test_new_locations_and_ratings_change_the_tile_and_its_etag(app):
+    _, etag = tile(app, 4, *HANOI[0])
+    with app.app_context():
+        user = User(username='ann', email='ann@example.com', password='123')
+        db.session.add_all([user, Location(name='place3', description='', latitude=21.03, longitude=105.85)])
+        db.session.flush()
+        db.session.add(Review(body='lovely place', rating=4, user_id=user.id, location_id=1))
+        db.session.commit()
+        app.extensions['tile_index'].update_rating(1, 4.0)
+    body, new_etag = tile(app, 4, *HANOI[0])
+    assert new_etag != etag
+    assert counts(body) == [3]
+    assert body['clusters'][0]['rating'] == 4.0  # only rated locations count toward the average
+
+
+def test_moved_location_changes_cluster(app):
+    tile(app, 0, *PARIS)  # built
+    with app.app_context():
+        loc = db.session.get(Location, 3)
+        loc.latitude, loc.longitude = HANOI[0]
+        http_cache.bump('location', loc.id)
+        db.session.commit()
+    world, _ = tile(app, 0, *PARIS)
+    assert counts(world) == [3]
+    paris, _ = tile(app, 4, *PARIS)
+    assert paris['clusters'] == []
+
+
+def test_point_tiles_list_locations_above_the_cluster_zoom(app):
+    body, _ = tile(app, 12, *HANOI[0])
+    assert sorted(p['name'] for p in body['points']) == ['place0', 'place1']
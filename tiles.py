@@ -0,0 +1,224 @@
+import json
+import math
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import url_for
+from sqlalchemy import func, and_
+
+from ext import db, app_extension
+from models import Location, Review, EntityVersion
+
+# Each tile is split into an 8x8 grid (2**CELL_SHIFT); a cluster is everything in one cell.
+CELL_SHIFT = 3
+MAX_LAT = 85.05112878  # Web Mercator limit
+# Writers stamp updated_at before their commit, so a stamp can become visible a little
+# after a later one: refresh() looks back this far for moved locations.
+MOVE_LOOKBACK = timedelta(seconds=30)
+
+
+def tile_xy(lat, lon, z):
+    """Fractional Web Mercator tile coordinates of a point at zoom z."""
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    n = 1 << z
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    return min(max(x, 0), n - 1e-9), min(max(y, 0), n - 1e-9)
+
+
+def tile_bounds(z, x, y):
+    """(south, west, north, east) of a tile."""
+    n = 1 << z
+    def lat(ty): return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+    return lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0
+
+
+class TileIndex:
+    """Grid pyramid of Location clusters for zoomed-out map tiles.
+
+    Levels 0..max_cluster_zoom hold, per tile, a grid of cells with
+    [count, sum_lat, sum_lon, sum_rating, rated]. Above that zoom, tiles return
+    individual points, bucketed by their tile at max_cluster_zoom + 1.
+    Adding a location touches one cell per level and bumps those tiles' versions,
+    which is what the ETags and the rendered-tile cache key on.
+    New and moved locations reach every worker through refresh() (moves are found from
+    the 'location' version stamps, also bumped by the OSM import CLI); rating changes
+    through the cache bus.
+    """
+
+    def __init__(self, max_cluster_zoom=14, cache_size=4096, refresh_seconds=5):
+        self.max_cluster_zoom = max_cluster_zoom
+        self.cache_size = cache_size
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        self.bus = None
+        self._reset()
+
+    def init_app(self, app):
+        self.max_cluster_zoom = app.config.get('TILE_CLUSTER_MAX_ZOOM', self.max_cluster_zoom)
+        self.cache_size = app.config.get('TILE_CACHE_SIZE', self.cache_size)
+        self.refresh_seconds = app.config.get('TILE_REFRESH_SECONDS', self.refresh_seconds)
+        app.extensions['tile_index'] = self
+        self.bus = app.extensions['cache_bus']
+        self.bus.subscribe('tile_rating', self._set_rating, self.sync_ratings)
+
+    def _reset(self):
+        self._levels = {}            # z -> {(tx, ty): {(cx, cy): [count, sum_lat, sum_lon, sum_rating, rated]}}
+        self._points = {}            # (tx, ty) at point zoom -> {location_id: (lat, lon)}
+        self._locations = {}         # location_id -> (lat, lon, rating)
+        self._versions = {}          # (z, tx, ty) -> int
+        self._rendered = OrderedDict()  # (z, x, y) -> (version, body)
+        self._max_id = 0
+        self._moved_since = None     # refresh() re-reads positions of locations stamped after this
+        self._checked_at = None
+        self.build_id = uuid.uuid4().hex[:8]  # new ETags after a rebuild or restart
+
+    @property
+    def point_zoom(self):
+        return self.max_cluster_zoom + 1
+
+    # --- Building / incremental updates ---
+    def refresh(self):
+        """Pick up locations created since the last check (by any process), at most every few seconds."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.refresh_seconds: return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.refresh_seconds: return
+            stamp = db.session.query(func.max(EntityVersion.updated_at)).filter(EntityVersion.kind == 'location').scalar()
+            if self._moved_since is not None:
+                moved = db.session.query(Location.id, Location.latitude, Location.longitude) \
+                    .join(EntityVersion, and_(EntityVersion.kind == 'location', EntityVersion.entity_id == Location.id)) \
+                    .filter(EntityVersion.updated_at >= self._moved_since).all()
+                for loc_id, lat, lon in moved:
+                    self._move(loc_id, lat, lon)
+            self._moved_since = stamp - MOVE_LOOKBACK if stamp else datetime.min
+            avg_rating = func.coalesce(func.avg(Review.rating), 0)
+            rows = db.session.query(Location.id, Location.latitude, Location.longitude, avg_rating) \
+                .outerjoin(Review, Location.id == Review.location_id) \
+                .filter(Location.id > self._max_id).group_by(Location.id).all()
+            for loc_id, lat, lon, rating in rows:
+                self._add(loc_id, lat, lon, float(rating))
+            # Only advanced here: add_location() may run ahead of a lower id another worker inserted
+            if rows: self._max_id = max(self._max_id, max(r[0] for r in rows))
+            self._checked_at = now
+
+    def add_location(self, loc_id, lat, lon, rating=0.0):
+        with self._lock:
+            if self._checked_at is None: return  # not built yet; the first refresh() will load it
+            self._add(loc_id, lat, lon, rating)
+
+    def update_rating(self, loc_id, rating):
+        self._set_rating(loc_id, rating)
+        self.bus.publish('tile_rating', loc_id, rating)
+
+    def sync_ratings(self):
+        """Re-read every location's average rating, for rating changes this worker missed."""
+        with self._lock:
+            if self._checked_at is None: return
+        ratings = dict(db.session.query(Review.location_id, func.avg(Review.rating)).group_by(Review.location_id).all())
+        with self._lock:
+            for loc_id in list(self._locations):
+                self._set_rating(loc_id, float(ratings.get(loc_id) or 0))
+
+    def _set_rating(self, loc_id, rating):
+        with self._lock:
+            old = self._locations.get(loc_id)
+            if not old or old[2] == rating: return
+            lat, lon, old_rating = old
+            self._apply(lat, lon, 0, rating - old_rating, (rating > 0) - (old_rating > 0))
+            self._locations[loc_id] = (lat, lon, rating)
+            px, py = tile_xy(lat, lon, self.point_zoom)
+            self._bump(self.point_zoom, int(px), int(py))
+
+    def _move(self, loc_id, lat, lon):
+        old = self._locations.get(loc_id)
+        if not old or old[:2] == (lat, lon): return
+        old_lat, old_lon, rating = old
+        self._apply(old_lat, old_lon, -1, -rating, -1 if rating > 0 else 0)
+        px, py = tile_xy(old_lat, old_lon, self.point_zoom)
+        self._points.get((int(px), int(py)), {}).pop(loc_id, None)
+        self._bump(self.point_zoom, int(px), int(py))
+        del self._locations[loc_id]
+        self._add(loc_id, lat, lon, rating)
+
+    def _add(self, loc_id, lat, lon, rating):
+        if loc_id in self._locations: return
+        self._locations[loc_id] = (lat, lon, rating)
+        self._apply(lat, lon, 1, rating, 1 if rating > 0 else 0)
+        px, py = tile_xy(lat, lon, self.point_zoom)
+        self._points.setdefault((int(px), int(py)), {})[loc_id] = (lat, lon)
+        self._bump(self.point_zoom, int(px), int(py))
+
+    def _apply(self, lat, lon, count, rating_sum, rated):
+        for z in range(self.max_cluster_zoom + 1):
+            fx, fy = tile_xy(lat, lon, z + CELL_SHIFT)
+            cx, cy = int(fx), int(fy)
+            tile = (cx >> CELL_SHIFT, cy >> CELL_SHIFT)
+            cell = self._levels.setdefault(z, {}).setdefault(tile, {}).setdefault((cx, cy), [0, 0.0, 0.0, 0.0, 0])
+            cell[0] += count
+            cell[1] += lat * count
+            cell[2] += lon * count
+            cell[3] += rating_sum
+            cell[4] += rated
+            self._bump(z, *tile)
+
+    def _bump(self, z, tx, ty):
+        self._versions[(z, tx, ty)] = self._versions.get((z, tx, ty), 0) + 1
+
+    # --- Reading ---
+    def _source(self, z, x, y):
+        """The (level, tile) whose data a requested tile is rendered from."""
+        if z <= self.max_cluster_zoom: return (z, x, y)
+        shift = z - self.point_zoom
+        return (self.point_zoom, x >> shift, y >> shift)
+
+    def etag(self, z, x, y):
+        return f"{self.build_id}-{z}-{x}-{y}-{self._versions.get(self._source(z, x, y), 0)}"
+
+    def render(self, z, x, y):
+        """JSON body for a tile, served from the rendered-tile cache while its version is unchanged."""
+        key = (z, x, y)
+        version = self._versions.get(self._source(z, x, y), 0)
+        with self._lock:
+            hit = self._rendered.get(key)
+            if hit and hit[0] == version:
+                self._rendered.move_to_end(key)
+                return hit[1]
+
+        if z <= self.max_cluster_zoom:
+            body = {'z': z, 'x': x, 'y': y, 'clusters': self._clusters(z, x, y)}
+        else:
+            body = {'z': z, 'x': x, 'y': y, 'points': self._point_details(z, x, y)}
+        body = json.dumps(body, separators=(',', ':'))
+
+        with self._lock:
+            self._rendered[key] = (version, body)
+            while len(self._rendered) > self.cache_size:
+                self._rendered.popitem(last=False)
+        return body
+
+    def _clusters(self, z, x, y):
+        with self._lock:
+            cells = [tuple(c) for c in self._levels.get(z, {}).get((x, y), {}).values()]
+        return [{'lat': s_lat / n, 'lon': s_lon / n, 'count': n,
+                 'rating': round(s_rating / rated, 2) if rated else 0}
+                for n, s_lat, s_lon, s_rating, rated in cells if n > 0]
+
+    def _point_details(self, z, x, y):
+        _, px, py = self._source(z, x, y)
+        south, west, north, east = tile_bounds(z, x, y)
+        with self._lock:
+            ids = [loc_id for loc_id, (lat, lon) in self._points.get((px, py), {}).items()
+                   if south <= lat < north and west <= lon < east]
+            ratings = {loc_id: self._locations[loc_id][2] for loc_id in ids}
+        if not ids: return []
+        rows = db.session.query(Location.id, Location.name, Location.description, Location.latitude, Location.longitude) \
+            .filter(Location.id.in_(ids)).all()
+        return [{'id': loc_id, 'name': name, 'desc': desc, 'lat': lat, 'lon': lon, 'rating': ratings[loc_id],
+                 'url': url_for('location_detail', location_id=loc_id)}
+                for loc_id, name, desc, lat, lon in rows]
+
+
+tile_index = app_extension('tile_index')
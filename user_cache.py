@@ -0,0 +1,85 @@
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+
+from ext import db, app_extension
+from models import User
+
+# Columns kept in the cache. The password is left out on purpose:
+# it is only needed at login, which queries the table directly.
+CACHED_COLUMNS = ('id', 'username', 'email')
+
+
+class UserCache:
+    """Bounded LRU + TTL cache for the user loaded on every request / socket event."""
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # user_id -> (expires_at, {column: value})
+        self._lock = threading.Lock()
+        self.bus = None
+
+    def init_app(self, app):
+        self.max_size = app.config.get('USER_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+        app.extensions['user_cache'] = self
+        self.bus = app.extensions['cache_bus']
+        self.bus.subscribe('user', self._drop, self.clear)
+
+    def get(self, user_id):
+        user_id = int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry and entry[0] > now:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                row = entry[1]
+            else:
+                if entry: del self._data[user_id]
+                self.misses += 1
+                row = None
+
+        if row is None:
+            user = db.session.get(User, user_id)
+            if user: self._store(user)
+            return user
+
+        # Rebuild the instance and attach it to the current session without a query,
+        # so relationships (rooms, favorites...) still lazy-load as usual.
+        user = User(**row)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def _store(self, user):
+        row = {col: getattr(user, col) for col in CACHED_COLUMNS}
+        with self._lock:
+            self._data[user.id] = (time.monotonic() + self.ttl, row)
+            self._data.move_to_end(user.id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop the user here and in the other workers (the TTL bounds anything missed)."""
+        self._drop(user_id)
+        self.bus.publish('user', int(user_id))
+
+    def _drop(self, user_id):
+        with self._lock:
+            self._data.pop(int(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+user_cache = app_extension('user_cache')